@@ -0,0 +1,307 @@
+from typing import Hashable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from JV_plotter_GUI.instruments import parallel_map
+
+
+class BatchIVEngine:
+    """
+    Calculate the IV parameters of many sweeps at once.
+
+    All the sweeps are concatenated into flat voltage and current arrays, with the offsets of the sweeps kept aside
+    (a ragged layout, so the memory grows with the number of points, not with the longest sweep). Every per-sweep
+    step (maximum power point, Voc approximation, Isc and Voc fits) is then a handful of vectorized operations over all
+    the points, with np.ufunc.reduceat doing the per-sweep reductions.
+    The calculations are the same as in CalculateIVParameters:
+        - MPP: the point of the maximum I * V.
+        - Isc and Rsh: linear fit of the points with |V| / Voc_approx < 0.3, Voc_approx being the voltage of the point
+          with the smallest |I|.
+        - Voc and Rs: linear fit through the point with the smallest |I| and the point before it. A sweep where that
+          point is the first one cannot be fitted, it is flagged and gets Voc = Rs = 0.
+    With interpolate, the MPP and Voc are not limited to the measured points: a quadratic through the sample with the
+    largest power and its two neighbours gives the MPP at its vertex, and a quadratic through the sample with the
+    smallest |I| and its neighbours gives Voc at its root, with Rs from its slope there. A sweep where the quadratic
+    has no such vertex or root between the outer points (an MPP or Voc at the end of the sweep, or noisy points) keeps
+    the values above. Isc is the intercept of a fit already, so it is not changed. This lets the sweeps be measured
+    with coarser voltage steps.
+    The calculation is split into the parameters which depend on the IV data only (intermediates) and the cheap
+    scaling by the active area and the light intensity, so the intermediates may be memoized (see ParameterMemo).
+
+    Median errors, sweeps of 0 - 1.2 V with 25 points (step 50 mV), against the same sweeps with 5000 points:
+    - Measured points: Voc ~0.5 mV, Vmpp ~12 mV, Pmax ~0.23 %, Rs ~5 %
+    - Interpolated: Voc ~0.05 mV, Vmpp ~3.5 mV, Pmax ~0.12 %, Rs ~0.3 %
+    """
+    columns = ['Efficiency', 'Isc', 'Voc', 'Fill factor', 'Maximum power', 'V mpp', 'J mpp', 'Rs', 'Rsh',
+               'Voc fit failed']
+    intermediate_columns = ['Isc', 'Voc', 'Fill factor', 'Maximum power', 'V mpp', 'I mpp', 'Rs', 'Rsh',
+                            'Voc fit failed']
+
+    def __init__(self, voltages: List[np.ndarray], currents: List[np.ndarray],
+                 active_areas: Optional[List[float]] = None, light_intensities: Optional[List[float]] = None,
+                 interpolate: bool = False):
+        """
+        :param voltages: Voltage of every sweep.
+        :param currents: Current of every sweep, in A.
+        :param active_areas: (Optional) Active area of the device of every sweep, in cm². Needed by calculate only.
+        :param light_intensities: (Optional) Light intensity of every sweep, in W/cm². Needed by calculate only.
+        :param interpolate: (Optional) Whether to find the MPP and Voc between the measured points.
+        """
+        self.lengths = np.array([len(v) for v in voltages], dtype=np.int64)
+        if np.any(self.lengths == 0):
+            raise ValueError("attempt to calculate the IV parameters of an empty sweep")
+        self.starts = np.concatenate(([0], np.cumsum(self.lengths)[:-1])).astype(np.int64)
+        self.voltage = np.concatenate(voltages).astype(float) if len(voltages) else np.empty(0)
+        self.current = np.concatenate(currents).astype(float) if len(currents) else np.empty(0)
+        self.active_areas = active_areas
+        self.light_intensities = light_intensities
+        self.interpolate = interpolate
+
+    def per_point(self, values: np.ndarray) -> np.ndarray:
+        """
+        Repeat a per-sweep value for every point of the sweep.
+        """
+        return np.repeat(values, self.lengths)
+
+    def first_index_of(self, values: np.ndarray, reduce: np.ufunc) -> np.ndarray:
+        """
+        Find the first point of every sweep where the values reach their per-sweep maximum or minimum, skipping NaN
+        (the same as argmax / argmin of a pandas Series per sweep).
+
+        :param values: Per-point values.
+        :param reduce: np.fmax or np.fmin.
+        :return: Global indexes of the points.
+        """
+        extreme = reduce.reduceat(values, self.starts)
+        positions = np.where(values == self.per_point(extreme), np.arange(len(values)), len(values))
+        # A sweep of NaN only has no such point, its last point is taken
+        return np.minimum(np.minimum.reduceat(positions, self.starts), self.starts + self.lengths - 1)
+
+    @staticmethod
+    def linear_fits(x: np.ndarray, y: np.ndarray, starts: np.ndarray, mask: Optional[np.ndarray] = None,
+                    min_conditioning: float = 1e-9) -> tuple:
+        """
+        Least squares lines y = intercept + slope * x of many fit windows at once.
+
+        The windows are consecutive slices of x and y beginning at the starts; the points outside the mask are left out.
+        Every line is found in the closed form from the per-window sums (n, Σx, Σy, Σx², Σxy):
+            slope = (n Σxy - Σx Σy) / (n Σx² - (Σx)²), intercept = (Σy - slope Σx) / n
+        The windows where the denominator is small compared to n Σx² (fewer than two distinct x, or the points nearly
+        on a vertical line) are ill-conditioned for this formula, and only these are fitted with np.linalg.lstsq, which
+        gives the minimum norm solution for them.
+
+        Speed (based on 10000 windows of 30 points):
+        - np.linalg.lstsq per window: ~0.33 seconds
+        - Closed form: ~0.009 seconds
+
+        :param x: The x values of all the windows.
+        :param y: The y values of all the windows.
+        :param starts: Index of the first point of every window, in increasing order. Windows must not be empty.
+        :param mask: (Optional) Boolean array, True for the points to fit. All the points by default.
+        :param min_conditioning: (Optional) The smallest (n Σx² - (Σx)²) / (n Σx²) fitted in the closed form.
+        :return: Arrays (intercept, slope), one value per window.
+        """
+        mask = np.ones(len(x), dtype=bool) if mask is None else mask
+        # The left out points become zeros, so they do not add anything to the sums (even if they are NaN)
+        masked_x, masked_y = np.where(mask, x, 0.0), np.where(mask, y, 0.0)
+        n = np.add.reduceat(mask.astype(float), starts)
+        sum_x, sum_y = np.add.reduceat(masked_x, starts), np.add.reduceat(masked_y, starts)
+        sum_xx = np.add.reduceat(masked_x * masked_x, starts)
+        sum_xy = np.add.reduceat(masked_x * masked_y, starts)
+
+        determinant = n * sum_xx - sum_x * sum_x
+        scale = n * sum_xx
+        well_conditioned = (n >= 2) & (determinant > min_conditioning * scale)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = np.where(well_conditioned, (n * sum_xy - sum_x * sum_y) / determinant, 0.0)
+            intercept = np.where(well_conditioned, (sum_y - slope * sum_x) / n, 0.0)
+
+        ends = np.append(starts[1:], len(x))
+        for window in np.flatnonzero(~well_conditioned):
+            selected = mask[starts[window]:ends[window]]
+            window_x = x[starts[window]:ends[window]][selected]
+            window_y = y[starts[window]:ends[window]][selected]
+            design_matrix = np.vstack([np.ones(window_x.shape[0]), window_x]).T
+            intercept[window], slope[window] = np.linalg.lstsq(design_matrix, window_y, rcond=None)[0]
+        return intercept, slope
+
+    def local_quadratics(self, y: np.ndarray, centers: np.ndarray) -> tuple:
+        """
+        Quadratics y = y0 + d1 (V - V0) + c (V - V0) (V - V1) through the points centers - 1, centers, centers + 1
+        (Newton's form, V0 and V1 being the voltages of the first two points).
+
+        :param y: Per-point values.
+        :param centers: Global index of the middle point of every sweep.
+        :return: Tuple (V0, V1, V2, y0, d1, c, valid). Not valid are the quadratics of the centers at either end of
+                 their sweep, and the ones through repeated voltages.
+        """
+        valid = (centers > self.starts) & (centers < self.starts + self.lengths - 1)
+        before, after = np.where(valid, centers - 1, centers), np.where(valid, centers + 1, centers)
+        v0, v1, v2 = self.voltage[before], self.voltage[centers], self.voltage[after]
+        y0, y1, y2 = y[before], y[centers], y[after]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d1 = (y1 - y0) / (v1 - v0)
+            c = ((y2 - y1) / (v2 - v1) - d1) / (v2 - v0)
+        valid &= np.isfinite(d1) & np.isfinite(c)
+        return v0, v1, v2, y0, d1, c, valid
+
+    def interpolate_mpp(self, power: np.ndarray, mpp_index: np.ndarray) -> tuple:
+        """
+        The MPP at the vertex of the quadratic through the point with the largest power and its neighbours.
+
+        :return: Tuple (maximum power, V mpp, I mpp), the measured point where the vertex is not a maximum between the
+                 neighbours.
+        """
+        v0, v1, v2, p0, d1, c, valid = self.local_quadratics(power, mpp_index)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vertex = (v0 + v1) / 2 - d1 / (2 * c)
+            vertex_power = p0 + d1 * (vertex - v0) + c * (vertex - v0) * (vertex - v1)
+            valid &= (c < 0) & (vertex >= np.minimum(v0, v2)) & (vertex <= np.maximum(v0, v2)) & (vertex != 0)
+            max_power = np.where(valid, vertex_power, power[mpp_index])
+            v_mpp = np.where(valid, vertex, v1)
+            i_mpp = np.where(valid, max_power / vertex, self.current[mpp_index])
+        return max_power, v_mpp, i_mpp
+
+    def interpolate_voc(self, voc_index: np.ndarray) -> tuple:
+        """
+        Voc at the root of the quadratic through the point with the smallest |I| and its neighbours (the root closest
+        to the middle point), Rs from the slope there.
+
+        :return: Tuple (Voc, Rs, valid). Not valid where there is no root between the neighbours.
+        """
+        v0, v1, v2, i0, d1, c, valid = self.local_quadratics(self.current, voc_index)
+        # The quadratic as c V² + b V + a
+        b = d1 - c * (v0 + v1)
+        a = i0 - d1 * v0 + c * v0 * v1
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            discriminant = b * b - 4 * a * c
+            square_root = np.sqrt(np.maximum(discriminant, 0))
+            # The numerically stable pair of the roots, a / q is also the root of the linear case (c = 0, q = -b)
+            q = -(b + np.where(b >= 0, 1, -1) * square_root) / 2
+            roots = np.stack([np.where(c != 0, q / c, np.nan), a / q])
+            closest = np.argmin(np.abs(np.nan_to_num(roots - v1, nan=np.inf)), axis=0)
+            voc = np.take_along_axis(roots, closest[None], axis=0)[0]
+            slope = d1 + c * (2 * voc - v0 - v1)
+            valid &= (discriminant >= 0) & np.isfinite(voc) & (slope != 0) & np.isfinite(slope)
+            valid &= (voc >= np.minimum(v0, v2)) & (voc <= np.maximum(v0, v2))
+            rs = -1 / slope
+        return voc, rs, valid
+
+    def calculate(self) -> pd.DataFrame:
+        """
+        Calculate the parameters of all the sweeps.
+
+        :return: Table with a row per sweep (in the order the sweeps were given) and the columns listed in
+                 BatchIVEngine.columns. Currents are in A, powers in W, resistances in ohm.
+        """
+        return self.scale(self.intermediates(), self.active_areas, self.light_intensities)
+
+    @classmethod
+    def scale(cls, intermediates: pd.DataFrame, active_areas: List[float], light_intensities: List[float]):
+        """
+        Turn the intermediates into the final parameters of the devices.
+
+        :param intermediates: Table returned by intermediates.
+        :param active_areas: Active area of the device of every sweep, in cm².
+        :param light_intensities: Light intensity of every sweep, in W/cm².
+        :return: Table with the columns listed in BatchIVEngine.columns.
+        """
+        active_areas = np.asarray(active_areas, dtype=float)
+        light_intensities = np.asarray(light_intensities, dtype=float)
+        table = intermediates.drop(columns=['I mpp'])
+        table['J mpp'] = intermediates['I mpp'].to_numpy(dtype=float) / active_areas
+        table['Efficiency'] = 100 * intermediates['Maximum power'].to_numpy(dtype=float) / (light_intensities *
+                                                                                         active_areas)
+        return table[cls.columns]
+
+    @classmethod
+    def sharded_intermediates(cls, voltages: List[np.ndarray], currents: List[np.ndarray], shards: List[Hashable],
+                              workers: Optional[int] = None, interpolate: bool = False) -> pd.DataFrame:
+        """
+        Calculate the intermediates with every shard of the sweeps in its own worker process.
+
+        The shards are independent of each other (the top-level folders, for example), so every one is a separate
+        batch. The tables of the shards are concatenated in the order the shards appear, giving the same rows as
+        intermediates of all the sweeps at once.
+
+        :param voltages: Voltage of every sweep.
+        :param currents: Current of every sweep, in A.
+        :param shards: Label of the shard of every sweep. The sweeps of a shard must be consecutive.
+        :param workers: (Optional) Number of worker processes, see instruments.parallel_map.
+        :param interpolate: (Optional) Whether to find the MPP and Voc between the measured points.
+        :return: The same table as intermediates.
+        """
+        bounds = [0] + [index for index in range(1, len(shards)) if shards[index] != shards[index - 1]] + [len(shards)]
+        tasks = [(voltages[start:end], currents[start:end], interpolate)
+                 for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+        if not tasks:
+            return cls([], [], interpolate=interpolate).intermediates()
+        tables = parallel_map(intermediates_in_worker, tasks, workers=workers, min_items_per_worker=1)
+        return pd.concat(tables, ignore_index=True)
+
+    def intermediates(self) -> pd.DataFrame:
+        """
+        Calculate the parameters which do not depend on the active area and the light intensity.
+
+        :return: Table with a row per sweep (in the order the sweeps were given) and the columns listed in
+                 BatchIVEngine.intermediate_columns.
+        """
+        if len(self.lengths) == 0:
+            return pd.DataFrame({column: pd.Series(dtype=bool if column == 'Voc fit failed' else float)
+                                 for column in self.intermediate_columns})
+        voltage, current = self.voltage, self.current
+
+        # Maximum power point
+        power = voltage * current
+        mpp_index = self.first_index_of(power, np.fmax)
+        max_power = power[mpp_index]
+        v_mpp = voltage[mpp_index]
+        i_mpp = current[mpp_index]
+        if self.interpolate:
+            max_power, v_mpp, i_mpp = self.interpolate_mpp(power, mpp_index)
+
+        # Voc approximation, the point with the smallest |I|
+        voc_index = self.first_index_of(np.abs(current), np.fmin)
+        voc_approx = voltage[voc_index]
+
+        # Isc and Rsh from the points close to V = 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            isc_mask = np.abs(voltage) / self.per_point(voc_approx) < 0.3
+        isc_intercept, isc_slope = self.linear_fits(voltage, current, self.starts, isc_mask)
+        isc = np.where(isc_intercept == 0, 0.0001, isc_intercept)
+        with np.errstate(divide='ignore'):
+            rsh = np.where(isc_slope == 0, 10000, -1 / isc_slope)
+
+        # Voc and Rs from the two points around I = 0
+        voc_fit_failed = voc_index == self.starts
+        previous = np.where(voc_fit_failed, voc_index, voc_index - 1)
+        pairs = np.stack([previous, voc_index], axis=-1).ravel()
+        voc_intercept, voc_slope = self.linear_fits(voltage[pairs], current[pairs], np.arange(0, len(pairs), 2))
+        # The same defaults CalculateIVParameters uses for a failed fit, giving Voc = Rs = 0
+        voc_intercept = np.where(voc_fit_failed, 1e-9, voc_intercept)
+        voc_slope = np.where(voc_fit_failed, 0, voc_slope)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            voc = np.where(voc_slope != 0, -voc_intercept / voc_slope, 0)
+            rs = np.where(voc_slope == 0, 0.0, -1 / voc_slope)
+        if self.interpolate:
+            interpolated_voc, interpolated_rs, valid = self.interpolate_voc(voc_index)
+            valid &= ~voc_fit_failed
+            voc, rs = np.where(valid, interpolated_voc, voc), np.where(valid, interpolated_rs, rs)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fill_factor = np.where(isc * voc == 0, 0.0, max_power / (isc * voc))
+
+        return pd.DataFrame({'Isc': isc, 'Voc': voc, 'Fill factor': fill_factor, 'Maximum power': max_power,
+                             'V mpp': v_mpp, 'I mpp': i_mpp, 'Rs': rs, 'Rsh': rsh, 'Voc fit failed': voc_fit_failed},
+                            columns=self.intermediate_columns)
+
+
+def intermediates_in_worker(task: tuple) -> pd.DataFrame:
+    """
+    Calculate the intermediates of one shard in a worker process (see BatchIVEngine.sharded_intermediates).
+
+    :param task: Tuple (voltages, currents, interpolate) of the sweeps of the shard.
+    :return: The table returned by BatchIVEngine.intermediates.
+    """
+    voltages, currents, interpolate = task
+    return BatchIVEngine(voltages, currents, interpolate=interpolate).intermediates()
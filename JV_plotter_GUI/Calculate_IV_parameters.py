@@ -2,6 +2,9 @@ from tkinter import messagebox
 
 import numpy as np
 
+from JV_plotter_GUI.Batch_IV_engine import BatchIVEngine
+from JV_plotter_GUI.Device_records import ParameterSet
+from JV_plotter_GUI.Single_diode_fit import SingleDiodeFitter
 from JV_plotter_GUI.settings import settings
 
 
@@ -9,10 +12,20 @@ class CalculateIVParameters:
     """
     This class is designed for analyzing device measurements, specifically for photovoltaic devices.
     """
-    def __init__(self, parent, matched_devices: dict):
+    def __init__(self, parent, matched_devices: dict, memo=None):
+        """
+        :param parent: The main frame.
+        :param matched_devices: The devices of every folder.
+        :param memo: (Optional) ParameterMemo to reuse the parameters of the sweeps calculated before.
+        """
         self.data = matched_devices
         self.parent = parent
+        self.memo = memo
+        self.sharded = settings['IV calculation']['sharded']
+        self.workers = settings['IV calculation']['workers']
+        self.interpolate = settings['IV calculation']['interpolate']
         self.warning_messages = []
+        self.diode_fit_warning = None
         self.efficiency_forward, self.efficiency_reverse = None, None
         self.i_sc_forward, self.i_sc_reverse = None, None
         self.v_oc_forward, self.v_oc_reverse = None, None
@@ -22,9 +35,12 @@ class CalculateIVParameters:
         self.j_mpp_forward, self.j_mpp_reverse = None, None
         self.rs_forward, self.rs_reverse = None, None
         self.rsh_forward, self.rsh_reverse = None, None
+        self.diode_forward, self.diode_reverse = None, None
         self.active_area, self.light_intensity, self.distance_to_light_source = None, None, None
         self.h_index = None
         self.parameter_dict = settings['parameter_dict']
+        self.diode_fit_settings = settings['Single diode fit']
+        self.aging_mode = getattr(parent, 'aging_mode', False)
 
         self.perform_calculation()
         if self.warning_messages:
@@ -32,110 +48,122 @@ class CalculateIVParameters:
             messagebox.showwarning("Warning!", f"Invalid data detected while calculating the\n"
                                                f"series resistance for the following devices:\n{all_warnings}\n"
                                                "This is likely due to bad JV data from a dead cell.")
+        if self.diode_fit_warning:
+            messagebox.showwarning("Warning!", self.diode_fit_warning)
 
     def perform_calculation(self):
-        # Iterate through the folders
+        # Collect the sweeps of all the devices and calculate their parameters in one batch, or in one batch per
+        # top-level folder if sharded (the folders are concatenated back in the order of self.data)
+        voltages, currents, active_areas, light_intensities, folders, sweep_keys = [], [], [], [], [], []
         for folder_name, devices in self.data.items():
-            # Iterate through the devices in each folder
             for device_name, device_data in devices.items():
-                self.active_area = device_data["Active area (cm²)"]
-                self.light_intensity = device_data['Light intensity (W/cm²)']
-                self.distance_to_light_source = device_data['Distance to light source (mm)']
-                for sweep_name, sweep_data in device_data['data'].items():
-                    power = sweep_data['I'] * sweep_data['V']
-                    ind_mpp = np.argmax(power)
-                    max_power = power[ind_mpp]
-                    v_mpp = sweep_data['V'][ind_mpp]
-                    j_mpp = sweep_data['I'][ind_mpp] / self.active_area
-                    eff = 100 * max_power / (self.light_intensity * self.active_area)  # Efficiency in percentage
-
-                    voc_approx, voc_index = self.calculate_voc_approx(sweep_data['V'], sweep_data['I'])
-                    isc, rsh, b = self.calculate_isc_and_rsh(sweep_data['V'], sweep_data['I'], voc_approx)
-                    voc, rs, b1 = self.calculate_voc_and_rs(sweep_data['V'], sweep_data['I'], voc_index,
-                                                            device_name, folder_name)
-                    ff = 0.0 if isc * voc == 0 else max_power / (isc * voc)  # Fill Factor
+                for sweep_name, sweep_data in device_data.data.items():
+                    # Zero-copy for the float64 views of a SweepStore
+                    voltages.append(np.asarray(sweep_data['V'], dtype=float))
+                    currents.append(np.asarray(sweep_data['I'], dtype=float))
+                    active_areas.append(device_data.active_area)
+                    light_intensities.append(device_data.light_intensity)
+                    folders.append(folder_name)
+                    sweep_keys.append((device_name, sweep_name))
+        shards = folders if self.sharded else None
+        if self.memo is not None:
+            intermediates = self.memo.intermediates(voltages, currents, shards, self.workers, self.interpolate)
+        elif self.sharded:
+            intermediates = BatchIVEngine.sharded_intermediates(voltages, currents, folders, workers=self.workers,
+                                                                interpolate=self.interpolate)
+        else:
+            intermediates = BatchIVEngine(voltages, currents, interpolate=self.interpolate).intermediates()
+        table = BatchIVEngine.scale(intermediates, active_areas, light_intensities)
+        # The rows as numpy scalars, so a zero division (a dead cell without power) gives NaN with a warning
+        rows = zip(*(table[column].to_numpy() for column in table.columns))
+        if self.diode_fit_settings['enabled']:
+            diode_rows = iter(self.fit_single_diode(voltages, currents, table, folders, sweep_keys).tolist())
+        else:
+            diode_rows = None
+
+        # Fan the results back into the devices, in the same order they were collected
+        for folder_name, devices in self.data.items():
+            for device_name, device_data in devices.items():
+                self.active_area = device_data.active_area
+                self.light_intensity = device_data.light_intensity
+                self.distance_to_light_source = device_data.distance_to_light_source
+                # NaN for a sweep the device does not have
+                self.diode_forward = self.diode_reverse = [np.nan] * len(SingleDiodeFitter.parameter_names)
+                for sweep_name in device_data.data:
+                    eff, isc, voc, ff, max_power, v_mpp, j_mpp, rs, rsh, voc_fit_failed = next(rows)
+                    diode = next(diode_rows) if diode_rows is not None else None
+                    if voc_fit_failed:
+                        self.warning_messages.append(f"{device_name} in {folder_name}")
                     if sweep_name == '1_Forward':
                         self.i_sc_forward, self.v_oc_forward = isc, voc
                         self.rs_forward, self.rsh_forward = rs, rsh
                         self.max_power_forward, self.j_mpp_forward, self.v_mpp_forward = max_power, j_mpp, v_mpp
                         self.efficiency_forward, self.fill_factor_forward = eff, ff
+                        self.diode_forward = diode
                     elif sweep_name == '2_Reverse':
                         self.i_sc_reverse, self.v_oc_reverse = isc, voc
                         self.rs_reverse, self.rsh_reverse = rs, rsh
                         self.max_power_reverse, self.j_mpp_reverse, self.v_mpp_reverse = max_power, j_mpp, v_mpp
                         self.efficiency_reverse, self.fill_factor_reverse = eff, ff
+                        self.diode_reverse = diode
 
                 self.fill_dict_with_iv_parameters(device_data=device_data)
-                device_data['H-index'] = self.h_index
-
-    @staticmethod
-    def calculate_voc_approx(voltage_data, current_data):
-        voc_index = np.argmin(np.abs(current_data))
-        return voltage_data[voc_index], voc_index
+                device_data.h_index = self.h_index
 
-    @staticmethod
-    def linfit_golden(x_data, y_data):
+    def fit_single_diode(self, voltages: list, currents: list, table, folders: list, sweep_keys: list) -> np.ndarray:
         """
-        A linear fit using various methods.
-        Uncomment the desired method.
-
-        :param x_data: np.ndarray
-            The x-values of the data points.
-        :param y_data: np.ndarray
-            The y-values of the data points.
-        :return: tuple
-            The slope and intercept of the best-fit line in the form (intercept, slope).
-
-        Speed (Based on 1000 iterations):
-        - The Least Squares Method: ~0.080 seconds
-        - Direct Solve Method: ~0.020 seconds
-        - Inverse Method: ~0.040 seconds
+        Fit the single diode model to all the sweeps, see SingleDiodeFitter.
+
+        The fits start from the Isc, Voc, Rs and Rsh of the table. In the aging mode the folders are the time points,
+        so they are fitted one after another, and every sweep starts from the converged fit of the same device and
+        sweep at the previous time point, if there is one.
+
+        :param voltages: Voltage of every sweep.
+        :param currents: Current of every sweep, in A.
+        :param table: The parameters of the sweeps, returned by BatchIVEngine.
+        :param folders: The folder of every sweep.
+        :param sweep_keys: Tuple (device name, sweep name) of every sweep.
+        :return: Array (sweeps, 5) of the fitted Iph, I0, n, Rs, Rsh, NaN where the fit did not converge.
         """
-        # Create design matrix
-        design_matrix = np.vstack([np.ones(x_data.shape[0]), x_data]).T
-
-        # Method 1: The Least Squares Method
-        # Recommended as the golden choice.
-        # More robust and can handle cases where the system of equations doesn't have a direct solution.
-        # Slower but generally more reliable (~0.080 seconds).
-        slope, intercept = np.linalg.lstsq(design_matrix, y_data, rcond=None)[0]
-
-        # Method 2: Direct Solve Method (Uncomment to use)
-        # Fastest method (~0.020 seconds).
-        # It may be less stable for ill-conditioned matrices.
-        # slope, intercept = np.linalg.solve(design_matrix.T @ design_matrix, design_matrix.T @ y_data)
-
-        # Method 3: Inverse Method (Uncomment to use)
-        # Moderate speed (~0.040 seconds).
-        # Involves direct matrix inversion, can be numerically unstable for ill-conditioned matrices.
-        # slope, intercept = np.linalg.inv(design_matrix.T @ design_matrix) @ design_matrix.T @ y_data
-
-        return intercept, slope
-
-    def calculate_isc_and_rsh(self, voltage_data, current_data, voc_approx):
-        isc_indices_fit = np.abs(voltage_data) / voc_approx < 0.3
-        intercept, slope = self.linfit_golden(voltage_data[isc_indices_fit], current_data[isc_indices_fit])
-        isc = 0.0001 if slope == 0 else slope
-        rsh = 10000 if intercept == 0 else -1 / intercept
-        return isc, rsh, (slope, intercept)
-
-    def calculate_voc_and_rs(self, voltage_data, current_data, voc_index, device_name, folder):
-        voc_indices_fit = [voc_index - 1, voc_index - 0] if current_data[voc_index] < 0 else [voc_index - 1, voc_index]
-        try:
-            intercept, slope = self.linfit_golden(voltage_data[voc_indices_fit], current_data[voc_indices_fit])
-        except KeyError:
-            self.warning_messages.append(f"{device_name} in {folder}")
-            # Handle the error as you see fit, perhaps setting intercept and slope to some default values
-            intercept, slope = 0, 1e-9  # Setting to some default values
-        voc = -slope / intercept if intercept != 0 else 0
-        rs = 0.0 if intercept == 0 else -1 / intercept
-        return voc, rs, (slope, intercept)
+        fit_settings = self.diode_fit_settings
+        # In the aging mode, one batch per folder, otherwise one batch of all the sweeps
+        if self.aging_mode:
+            batches = [np.flatnonzero(np.asarray(folders, dtype=object) == folder) for folder in self.data]
+        else:
+            batches = [np.arange(len(voltages))]
+
+        results = np.full((len(voltages), 5), np.nan)
+        converged, iterations, residuals = [], [], []
+        previous_fits = {}
+        for batch in batches:
+            fitter = SingleDiodeFitter([voltages[index] for index in batch], [currents[index] for index in batch],
+                                       temperature=fit_settings['temperature (K)'],
+                                       max_iterations=fit_settings['max_iterations'],
+                                       tolerance=fit_settings['tolerance'])
+            initial = fitter.initial_guess(*(table[column].to_numpy(dtype=float)[batch]
+                                             for column in ('Isc', 'Voc', 'Rs', 'Rsh')))
+            for position, index in enumerate(batch):
+                if sweep_keys[index] in previous_fits:
+                    initial[position] = previous_fits[sweep_keys[index]]
+            fitted = fitter.fit(initial)
+            results[batch] = np.where(fitter.converged[:, None], fitted, np.nan)
+            for position in np.flatnonzero(fitter.converged):
+                previous_fits[sweep_keys[batch[position]]] = fitter.fitted[position]
+            converged.append(fitter.converged)
+            iterations.append(fitter.iterations)
+            residuals.append(fitter.residuals)
+
+        if converged and not np.concatenate(converged).all():
+            summary = SingleDiodeFitter.summary(np.concatenate(converged), np.concatenate(iterations),
+                                                np.concatenate(residuals))
+            self.diode_fit_warning = f"{summary}.\nThe diode parameters of the other sweeps are NaN."
+        return results
 
     def fill_dict_with_iv_parameters(self, device_data: dict) -> None:
         # https://doi.org/10.1021/acsenergylett.8b01627
         self.h_index = (self.efficiency_reverse - self.efficiency_forward) / self.efficiency_reverse
-        device_data['Parameters'] = {}
-        device_data['Parameters']['Forward'] = {
+        device_data.parameters = {}
+        device_data.parameters['Forward'] = ParameterSet({
             self.parameter_dict[3]: self.efficiency_forward,
             self.parameter_dict[4]: 1000 * self.i_sc_forward / self.active_area,
             self.parameter_dict[5]: self.v_oc_forward,
@@ -145,8 +173,8 @@ class CalculateIVParameters:
             self.parameter_dict[9]: 1000 * self.j_mpp_forward,
             self.parameter_dict[10]: self.rs_forward,
             self.parameter_dict[11]: self.rsh_forward,
-        }
-        device_data['Parameters']['Reverse'] = {
+        })
+        device_data.parameters['Reverse'] = ParameterSet({
             self.parameter_dict[3]: self.efficiency_reverse,
             self.parameter_dict[4]: 1000 * self.i_sc_reverse / self.active_area,
             self.parameter_dict[5]: self.v_oc_reverse,
@@ -156,8 +184,8 @@ class CalculateIVParameters:
             self.parameter_dict[9]: 1000 * self.j_mpp_reverse,
             self.parameter_dict[10]: self.rs_reverse,
             self.parameter_dict[11]: self.rsh_reverse,
-        }
-        device_data['Parameters']['Average'] = {
+        })
+        device_data.parameters['Average'] = ParameterSet({
             self.parameter_dict[3]: (self.efficiency_reverse + self.efficiency_forward) / 2,
             self.parameter_dict[4]: 1000 * (self.i_sc_forward / self.active_area + self.i_sc_reverse /
                                             self.active_area) / 2,
@@ -168,7 +196,13 @@ class CalculateIVParameters:
             self.parameter_dict[9]: 1000 * (self.j_mpp_reverse + self.j_mpp_forward) / 2,
             self.parameter_dict[10]: (self.rs_forward + self.rs_reverse) / 2,
             self.parameter_dict[11]: (self.rsh_reverse + self.rsh_forward) / 2,
-        }
+        })
+        if self.diode_fit_settings['enabled']:
+            for name, forward, reverse in zip(SingleDiodeFitter.parameter_names, self.diode_forward,
+                                              self.diode_reverse):
+                device_data.parameters['Forward'][name] = forward
+                device_data.parameters['Reverse'][name] = reverse
+                device_data.parameters['Average'][name] = (forward + reverse) / 2
 
     def return_data(self):
         return self.data
@@ -0,0 +1,176 @@
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+
+class Device(MutableMapping):
+    """
+    The record of a device (a pixel, a merged substrate or a pair of single sweep files).
+
+    The known keys are kept in __slots__ and can be read as attributes (device.active_area, device.data), which is what
+    the hot loops use. The record is also a mapping with the same string keys as the dictionaries the devices used to
+    be ('Active area (cm²)', 'Used files', ...), so the rest of the code and the JSON dump work with it unchanged. Keys
+    not listed in fields are kept in a separate dictionary, created on the first such key.
+
+    The sweeps of a device (device.data) are SweepView records, see Sweep_store.
+
+    Memory (a merged device, 10 keys):
+    - Dictionary: ~280 bytes
+    - Device: ~160 bytes
+    """
+    # {key: attribute}, in the order the keys are iterated
+    fields = {
+        'path': 'path',
+        'measurement device': 'measurement_device',
+        'encoding': 'encoding',
+        'Sweeps': 'sweeps',
+        'data': 'data',
+        'unit': 'unit',
+        'Used files': 'used_files',
+        'Active area (cm²)': 'active_area',
+        'Light intensity (W/cm²)': 'light_intensity',
+        'Distance to light source (mm)': 'distance_to_light_source',
+        'Parameters': 'parameters',
+        'H-index': 'h_index',
+        'sheet_name': 'sheet_name',
+        'sweep_indexes_data': 'sweep_indexes',
+    }
+    __slots__ = (*fields.values(), 'extra')
+
+    def __init__(self, mapping: Optional[Dict[str, Any]] = None, **attributes):
+        """
+        :param mapping: (Optional) The values by their keys, as in the device dictionaries.
+        :param attributes: (Optional) The values by their attribute names, e.g. active_area=0.1.
+        """
+        self.extra = None
+        if mapping is not None:
+            self.update(mapping)
+        for attribute, value in attributes.items():
+            setattr(self, attribute, value)
+
+    def __getitem__(self, key: str) -> Any:
+        attribute = self.fields.get(key)
+        if attribute is None:
+            if self.extra is None:
+                raise KeyError(key)
+            return self.extra[key]
+        try:
+            return getattr(self, attribute)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        attribute = self.fields.get(key)
+        if attribute is not None:
+            setattr(self, attribute, value)
+        elif self.extra is None:
+            self.extra = {key: value}
+        else:
+            self.extra[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        attribute = self.fields.get(key)
+        if attribute is None:
+            if self.extra is None:
+                raise KeyError(key)
+            del self.extra[key]
+            return
+        try:
+            delattr(self, attribute)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __iter__(self) -> Iterator[str]:
+        for key, attribute in self.fields.items():
+            if hasattr(self, attribute):
+                yield key
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({dict(self)!r})'
+
+    def copy(self) -> 'Device':
+        """
+        :return: A shallow copy, like dict.copy.
+        """
+        return type(self)(self)
+
+
+class ParameterLayout:
+    """
+    The parameter names of a ParameterSet and their positions.
+
+    The layouts are shared: all the parameter sets with the same names in the same order point to the same layout,
+    so a device keeps only its values and not a dictionary of the names per sweep.
+    """
+    __slots__ = ('names', 'positions', 'extended')
+
+    def __init__(self, names: Tuple[str, ...] = ()):
+        self.names = names
+        self.positions = {name: position for position, name in enumerate(names)}
+        self.extended = {}
+
+    def extend(self, name: str) -> 'ParameterLayout':
+        """
+        :param name: The name to add.
+        :return: The (shared) layout with the name added at the end.
+        """
+        layout = self.extended.get(name)
+        if layout is None:
+            layout = self.extended[name] = ParameterLayout(self.names + (name,))
+        return layout
+
+
+class ParameterSet(MutableMapping):
+    """
+    The parameters of one sweep of a device, {parameter name: value}, with the names kept in a shared ParameterLayout.
+
+    Memory (14 parameters):
+    - Dictionary: ~470 bytes
+    - ParameterSet: ~240 bytes
+    """
+    __slots__ = ('layout', 'entries')
+    empty_layout = ParameterLayout()
+
+    def __init__(self, items: Optional[Iterable] = None):
+        """
+        :param items: (Optional) A dictionary or pairs (parameter name, value).
+        """
+        self.layout = self.empty_layout
+        self.entries = []
+        if items is not None:
+            self.update(items)
+
+    def __getitem__(self, key: str) -> Any:
+        return self.entries[self.layout.positions[key]]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        position = self.layout.positions.get(key)
+        if position is None:
+            self.layout = self.layout.extend(key)
+            self.entries.append(value)
+        else:
+            self.entries[position] = value
+
+    def __delitem__(self, key: str) -> None:
+        items = [(name, value) for name, value in zip(self.layout.names, self.entries) if name != key]
+        if len(items) == len(self.entries):
+            raise KeyError(key)
+        self.layout, self.entries = self.empty_layout, []
+        self.update(items)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.layout.names)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({dict(self)!r})'
+
+    def __reduce__(self):
+        # Pickled by the items, not the whole tree of the shared layouts
+        return type(self), (list(zip(self.layout.names, self.entries)),)
@@ -0,0 +1,83 @@
+import os
+from typing import List, Optional
+
+
+class DirectoryScanner:
+    """
+    Walk a directory tree once and classify every file in it with a PotentiostatFileChecker.
+
+    The result is a tree of nested dictionaries (nodes), so the same classification results serve both the decision
+    whether a folder contains any devices and the population of the files table.
+    Every node looks like:
+        {
+            'name': folder name,
+            'path': absolute path with forward slashes,
+            'content': list of entries in the os.listdir order, each entry is either
+                       ('file', file name, absolute path, check_file result) for the recognized files or
+                       ('folder', nested node) for the sub folders,
+            'has devices': True if the folder or any of its sub folders contains a recognized file,
+        }
+    The tree is walked first and only then all the candidate files are classified in one batch, so the parsing may be
+    spread over a process pool (see PotentiostatFileChecker.check_files).
+    """
+
+    def __init__(self, checker, workers: Optional[int] = None):
+        """
+        :param checker: PotentiostatFileChecker instance used to classify the files.
+        :param workers: (Optional) Number of worker processes for the parsing, see instruments.parallel_map.
+        """
+        self.checker = checker
+        self.workers = workers
+
+    def scan(self, path: str) -> dict:
+        """
+        Build the tree index of a directory.
+
+        :param path: Path to the directory.
+        :return: The root node of the tree.
+        """
+        candidates = []
+        tree = self.walk(path, candidates)
+        results = self.checker.check_files(candidates, workers=self.workers)
+        self.fill(tree, dict(zip(candidates, results)))
+        return tree
+
+    def walk(self, path: str, candidates: List[str]) -> dict:
+        """
+        List a directory recursively, without reading any file.
+
+        :param path: Path to the directory.
+        :param candidates: List to collect the paths of the files which may be potentiostat files.
+        :return: A node whose file entries are not classified yet.
+        """
+        node = {'name': os.path.basename(path), 'path': path, 'content': [], 'has devices': False}
+        for file in os.listdir(path):
+            abspath = os.path.join(path, file).replace('\\', '/')
+            if os.path.isfile(abspath) and self.checker.accepted_extension(abspath) is not None:
+                node['content'].append(('file', file, abspath, None))
+                candidates.append(abspath)
+            if os.path.isdir(abspath):
+                node['content'].append(('folder', self.walk(abspath, candidates)))
+        return node
+
+    def fill(self, node: dict, results: dict) -> bool:
+        """
+        Put the classification results into the tree, dropping the files which are not potentiostat files.
+
+        :param node: The node to fill.
+        :param results: Dictionary mapping the paths to the check_file results.
+        :return: Whether the node has any devices.
+        """
+        content = []
+        for entry in node['content']:
+            if entry[0] == 'file':
+                checking = results[entry[2]]
+                if checking[0]:  # Keep only the potentiostats files
+                    content.append(entry[:3] + (checking,))
+                    node['has devices'] = True
+            else:
+                content.append(entry)
+                if self.fill(entry[1], results):
+                    node['has devices'] = True
+        node['content'] = content
+        return node['has devices']
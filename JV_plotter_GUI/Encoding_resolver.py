@@ -0,0 +1,102 @@
+import codecs
+import os
+import re
+from typing import Optional
+
+import chardet
+
+# Byte order marks and the encodings they belong to
+BOMS = {
+    codecs.BOM_UTF8: ('utf-8-sig',),
+    codecs.BOM_UTF16_LE: ('utf-16', 'utf-16-le'),
+    codecs.BOM_UTF16_BE: ('utf-16', 'utf-16-be'),
+}
+
+
+class EncodingResolver:
+    """
+    Detect the encoding of the measurement files, learning it per directory.
+
+    All the files of one instrument in one folder share the same encoding, so once a file was identified, its encoding
+    is remembered for the (directory, extension, potentiostat) profile. The next files of the same directory and
+    extension are only checked against the profile (the byte order mark and a trial decoding of the first bytes), and
+    chardet is called only if none of the profiles fits.
+    """
+    head_size = 4096
+    # The control characters a text file does not have (all but the tab, line feed, form feed and carriage return),
+    # C1 included: latin-1 decodes any byte, the bytes of a UTF-8 or a cp1252 file included, into these
+    control_characters = re.compile('[\x00-\x08\x0b\x0e-\x1f\x7f-\x9f]')
+
+    def __init__(self):
+        # {(directory, extension): {potentiostat: encoding}}
+        self.profiles = {}
+
+    @staticmethod
+    def profile_key(path: str) -> tuple:
+        directory, file = os.path.split(os.path.abspath(path))
+        return directory, os.path.splitext(file)[1]
+
+    def validate(self, raw: bytes, encoding: str) -> bool:
+        """
+        Check cheaply if the beginning of a file fits an encoding.
+
+        :param raw: Content of the file (only the beginning is looked at).
+        :param encoding: The encoding to check.
+        :return: True if the byte order mark matches the encoding, the first bytes can be decoded with it into a text
+                 without control characters, and a single byte encoding is not given the non-ASCII bytes of UTF-8.
+        """
+        try:
+            name = codecs.lookup(encoding).name
+        except LookupError:
+            return False
+        head = raw[:self.head_size]
+        for bom, names in BOMS.items():
+            if head.startswith(bom):
+                return name in names
+        if name in ('utf-16', 'utf-8-sig'):
+            return False  # These files always start with the BOM
+        if '16' not in name and '32' not in name and b'\x00' in head:
+            return False  # Single byte encodings do not produce NUL bytes in a text file
+        try:
+            # The head may end in the middle of a character, so it is decoded as not final
+            text = codecs.getincrementaldecoder(name)().decode(head, final=False)
+        except UnicodeDecodeError:
+            return False
+        if self.control_characters.search(text):
+            return False
+        if not name.startswith('utf') and not head.isascii():
+            # The single byte encodings decode the UTF-8 text as well, into the wrong characters
+            try:
+                codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+            except UnicodeDecodeError:
+                return True
+            return False
+        return True
+
+    def resolve(self, path: str, raw: bytes) -> Optional[str]:
+        """
+        Find the encoding of a file.
+
+        :param path: Path to the file.
+        :param raw: Content of the file.
+        :return: The encoding, None if chardet could not detect it.
+        """
+        for encoding in self.profiles.get(self.profile_key(path), {}).values():
+            if self.validate(raw, encoding):
+                return encoding
+        return chardet.detect(raw[:self.head_size])['encoding']
+
+    def learn(self, path: str, potentiostat: str, encoding: Optional[str]) -> None:
+        """
+        Remember the encoding of an identified file for its directory, extension and potentiostat.
+
+        :param path: Path to the file.
+        :param potentiostat: The potentiostat the file belongs to.
+        :param encoding: The encoding used to read the file.
+        """
+        if encoding is not None:
+            self.profiles.setdefault(self.profile_key(path), {})[potentiostat] = encoding
+
+
+# Shared by all the checkers of a process, so the profiles survive between the files handled by a worker process
+encoding_resolver = EncodingResolver()
@@ -3,6 +3,11 @@ import os
 from datetime import datetime
 from typing import Any, Dict, Optional, List
 
+import numpy as np
+import pandas as pd
+
+from JV_plotter_GUI.Results_table import ResultsTable
+
 
 class FilterJVData:
     def __init__(self, parent=None):
@@ -17,59 +22,56 @@ class FilterJVData:
         self.log = []
         self.threshold_efficiency = float(self.parent.additional_settings.threshold_efficiency_entry.get())
 
-    def filter1(self, data: Dict[str, Any], substrates: Dict[str, List[str]]) -> Dict[str, Any]:
+    def filter1(self, data: Dict[str, Any], substrates: Dict[str, List[str]],
+                results: Optional[ResultsTable] = None) -> Dict[str, Any]:
         """
         Removes dead pixels from the data unless all pixels in a substrate are dead.
         A pixel is considered dead if its average efficiency is less than the given threshold efficiency.
         Default thresholding efficiency is 0.01%.
         If all pixels within a substrate are dead, none are deleted.
 
-        Iterates through each folder and device, checking each pixel's efficiency.
-        Dead pixels are removed only if at least one pixel in the same substrate is alive.
+        The pixels are grouped by (folder, substrate) in the results table, and the dead pixels of the groups with at
+        least one alive pixel are removed, in the order of the folders, substrates and pixels.
 
         :param substrates: A dictionary where each key is a substrate name, and its value is a list of
                            pixel names.
                            This is used for more advanced filtering based on substrates.
         :param data: A dictionary containing raw device data.
                      The data is expected to be structured with folder names as keys and devices as values.
+        :param results: (Optional) The results table of the data, the removed pixels are dropped from it as well.
+                        Built from the data if not given.
         :return: A tuple containing the modified data and a list of logs detailing the deletions.
         """
         current_frame = inspect.currentframe()
         method_name = inspect.getframeinfo(current_frame).function
         self.log.append(f"{method_name} is activated\n")
-        log_counter = 0
-        pixels_to_delete = {}
-
-        # Iterate through folders
-        for folder_name, devices in data.items():
-            # Check each substrate in the folder
-            for substrate_name, pixel_names in substrates.items():
-                dead_pixels = []
-                alive_pixels = []
-                # Check if the substrate's pixels are in the current folder
-                for pixel_name in pixel_names:
-                    if pixel_name in devices:
-                        pixel_data = devices[pixel_name]
-                        # Check each pixel's efficiency
-                        efficiency = pixel_data['Parameters']['Average']['Efficiency (%)']
-                        if efficiency < self.threshold_efficiency:
-                            dead_pixels.append(pixel_name)
-                        else:
-                            alive_pixels.append(pixel_name)
-                # Delete dead pixels if alive pixels exist in the same substrate
-                if alive_pixels:
-                    for dead_pixel in dead_pixels:
-                        if dead_pixel in devices:
-                            del devices[dead_pixel]
-                            # Log the deletion
-                            log_counter += 1
-                            self.log.append(f"Deleted dead pixel: {dead_pixel} in folder: {folder_name}")
-        if log_counter == 0:
+        results = results if results is not None else ResultsTable.from_devices(data)
+
+        # One row per (substrate, pixel) membership, a pixel may be listed in several substrates
+        membership = pd.DataFrame([(substrate_order, pixel_order, substrate_name, pixel_name)
+                                   for substrate_order, (substrate_name, pixel_names) in enumerate(substrates.items())
+                                   for pixel_order, pixel_name in enumerate(pixel_names)],
+                                  columns=['Substrate order', 'Pixel order', 'Group', 'Device'])
+        average = results.sweep('Average')[['Folder', 'Device', 'Efficiency (%)']]
+        average = average.assign(**{'Folder order': pd.factorize(average['Folder'])[0]})
+        pixels = average.merge(membership, on='Device')
+        pixels['Dead'] = pixels['Efficiency (%)'] < self.threshold_efficiency
+        # NaN efficiency counts as alive, as the comparison with the threshold fails
+        alive_in_group = (~pixels['Dead']).groupby([pixels['Folder'], pixels['Group']]).transform('any')
+        to_delete = pixels[pixels['Dead'] & alive_in_group].sort_values(
+            ['Folder order', 'Substrate order', 'Pixel order'], kind='stable').drop_duplicates(['Folder', 'Device'])
+
+        for folder_name, dead_pixel in to_delete[['Folder', 'Device']].itertuples(index=False, name=None):
+            del data[folder_name][dead_pixel]
+            # Log the deletion
+            self.log.append(f"Deleted dead pixel: {dead_pixel} in folder: {folder_name}")
+        results.drop_devices(to_delete[['Folder', 'Device']].itertuples(index=False, name=None))
+        if len(to_delete) == 0:
             self.log.append('No device was filtered out')
         self.log.append('\n')
         return data
 
-    def filter2(self, data: Dict[str, Any]) -> Dict[str, Any]:
+    def filter2(self, data: Dict[str, Any], results: Optional[ResultsTable] = None) -> Dict[str, Any]:
         """
         Removes specific erroneous measurement points from the data.
         It targets measurements where a device is dead (given threshold efficiency [default thresholding efficiency
@@ -77,41 +79,41 @@ class FilterJVData:
         Iterates through each device's measurements, identifying and marking dead-then-alive patterns.
         Such measurements are then deleted from the data.
 
+        With the measurements of a device in the folder order, a measurement is deleted if it is not alive, a dead one
+        came at or before it since the last alive one, and an alive one comes after it. This is found for all the
+        devices at once with cumulative sums in the results table.
+
         :param data: A dictionary containing raw device data.
         The data is expected to be structured with folder names as keys and devices as values.
+        :param results: (Optional) The results table of the data, the removed devices are dropped from it as well.
+                        Built from the data if not given.
         :return: A tuple containing the modified data and a list of logs detailing the deletions.
         """
         current_frame = inspect.currentframe()
         method_name = inspect.getframeinfo(current_frame).function
         self.log.append(f"{method_name} is activated\n")
-        log_counter = 0
-        device_efficiencies = {}
-        # Accumulate efficiencies for each device
-        for folder_name, devices in data.items():
-            for device_name, device_data in devices.items():
-                if 'Parameters' in device_data and 'Average' in device_data['Parameters']:
-                    efficiency = device_data['Parameters']['Average'].get('Efficiency (%)')
-                    if device_name not in device_efficiencies:
-                        device_efficiencies[device_name] = []
-                    device_efficiencies[device_name].append([folder_name, efficiency])
-
-        # Identify and delete erroneous measurements
-        for device, measurements in device_efficiencies.items():
-            to_delete = []
-            first_dead_index = None
-
-            for measurement_index, (date, efficiency) in enumerate(measurements):
-                if efficiency < self.threshold_efficiency and first_dead_index is None:
-                    first_dead_index = measurement_index
-                elif efficiency >= self.threshold_efficiency and first_dead_index is not None:
-                    to_delete.extend(range(first_dead_index, measurement_index))
-                    first_dead_index = None
-            for measurement in to_delete:
-                folder_name = measurements[measurement][0]
-                del data[folder_name][device]
-                log_counter += 1
-                self.log.append(f"{log_counter}. Deleted dead device in the folder: {folder_name}, device: {device}")
-        if log_counter == 0:
+        results = results if results is not None else ResultsTable.from_devices(data)
+
+        measurements = results.sweep('Average')[['Folder', 'Device', 'Efficiency (%)']].reset_index(drop=True)
+        efficiency = measurements['Efficiency (%)'].to_numpy(dtype=float)
+        dead = efficiency < self.threshold_efficiency
+        alive = efficiency >= self.threshold_efficiency
+        device = measurements['Device']
+        # Every alive measurement starts a new segment of its device
+        segment = pd.Series(alive.astype(np.int64)).groupby(device).cumsum()
+        dead_seen = pd.Series(dead).groupby([device, segment]).cummax().to_numpy(dtype=bool)
+        alive_later = (segment < segment.groupby(device).transform('max')).to_numpy()
+        to_delete = measurements[~alive & dead_seen & alive_later]
+        # The devices in the order of their first measurement, as the log is
+        device_order = pd.Series(pd.factorize(device)[0], index=measurements.index)
+        to_delete = to_delete.loc[device_order[to_delete.index].sort_values(kind='stable').index]
+
+        for log_counter, (folder_name, device_name) in enumerate(
+                to_delete[['Folder', 'Device']].itertuples(index=False, name=None), start=1):
+            del data[folder_name][device_name]
+            self.log.append(f"{log_counter}. Deleted dead device in the folder: {folder_name}, device: {device_name}")
+        results.drop_devices(to_delete[['Folder', 'Device']].itertuples(index=False, name=None))
+        if len(to_delete) == 0:
             self.log.append('No device was filtered out')
         self.log.append('\n')
         return data
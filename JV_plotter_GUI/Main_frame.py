@@ -11,12 +11,18 @@ from CTkMessagebox import CTkMessagebox
 from JV_plotter_GUI.Additional_settings_panel import AdditionalSettings
 from JV_plotter_GUI.Calculate_IV_parameters import CalculateIVParameters
 from JV_plotter_GUI.Device_filter import DeviceDetector
+from JV_plotter_GUI.Device_records import Device
+from JV_plotter_GUI.Directory_scanner import DirectoryScanner
 from JV_plotter_GUI.Filter_data import FilterJVData
+from JV_plotter_GUI.Parameter_memo import ParameterMemo
+from JV_plotter_GUI.Parse_cache import ParseCache
 from JV_plotter_GUI.Pixel_merger import PixelMerger
 from JV_plotter_GUI.Pixel_sorter import PixelGroupingManager, PixelSorterInterface
+from JV_plotter_GUI.Results_table import ResultsTable
 from JV_plotter_GUI.Plotter import DevicePlotter
 from JV_plotter_GUI.Potentostats_check import PotentiostatFileChecker
 from JV_plotter_GUI.Slide_frame import SettingsPanel
+from JV_plotter_GUI.Sweep_store import SweepStore
 from JV_plotter_GUI.The_lower_frames import LowestFrame, ProceedFrame
 from JV_plotter_GUI.TimeLine_detector import TimeLineProcessor
 from JV_plotter_GUI.Top_frame import TopmostFrame
@@ -43,6 +49,9 @@ class IVProcessingMainClass(ctk.CTkFrame):
         self.timeline_df = None
         self.files_selected = []
         self.added_iv = defaultdict(dict)
+        self.parse_cache = ParseCache()
+        self.parameter_memo = ParameterMemo()
+        self.results = None
         self.aging_mode = False
         self.iaa = True
         self.open_wb = True
@@ -219,52 +228,50 @@ class IVProcessingMainClass(ctk.CTkFrame):
         abspath = os.path.abspath(self.file_directory).replace('\\', '/')
         root_node = self.table_frame.files_table.insert('', 'end', text=os.path.basename(abspath), open=True)
         self.added_iv.clear()
-        self.process_directory(root_node, abspath)
-
-    def process_directory(self, parent, path, is_root_call: Optional[bool] = True):
+        potentiostat_checker = PotentiostatFileChecker(parent=self, potentiostat_choice=self.potentiostat,
+                                                       cache=self.parse_cache,
+                                                       metadata_only=settings['File scan']['metadata_only'])
+        directory_tree = DirectoryScanner(checker=potentiostat_checker).scan(abspath)
+        self.parse_cache.flush()
+        self.process_directory(root_node, directory_tree)
+
+    def process_directory(self, parent, node, is_root_call: Optional[bool] = True):
         """
         Insert to a table and into the file_list filtered by extension type of files, including nested folders.
         Will show folders only if it contains required file.
         :param parent: Parent folder
-        :param path: path to work with
+        :param node: Node of the directory tree (built by the DirectoryScanner) to work with
         :param is_root_call: A boolean flag,
         that checks whether the current call to process_directory is the initial (root-level) call.
         :return: None
         """
         depth = 1 if self.aging_mode else 0
-        potentiostat_checker = PotentiostatFileChecker(parent=self, potentiostat_choice=self.potentiostat)
-
-        for file in os.listdir(path):
-            abspath = os.path.join(path, file).replace('\\', '/')
-            b = path.replace(self.file_directory, '').count('/')
-            if os.path.isfile(abspath):
-                checking = potentiostat_checker.check_file(abspath)
-                if checking[0]:  # Insert a file only if it's potentiostats file
-                    potentiostat = checking[2]
-                    data = [potentiostat, checking[-1]['Unit'], abspath]
-                    folder_name = os.path.basename(path)
-                    if folder_name not in self.added_iv:
-                        self.added_iv[folder_name] = {}
-                    self.added_iv[folder_name][file] = {
-                        "path": abspath,
-                        'measurement device': potentiostat,
-                        'encoding': checking[1],
-                        'Sweeps': checking[3]["Counts"],
-                        'data': checking[3]["Data"],
-                        'unit': checking[3]['Unit'],
-                        'Used files': file,
-                    }
-                    self.table_frame.files_table.insert(parent=parent, index=tk.END, text=file, values=data,
-                                                        tags='file')
-            if os.path.isdir(abspath):
-                device_detected = False
-                for dir_path, dir_names, files in os.walk(abspath):
-                    for filename in files:
-                        f_name = os.path.join(dir_path, filename).replace('\\', '/')
-                        checking = potentiostat_checker.check_file(f_name)
-                        if checking[0]:
-                            device_detected = True
-                if device_detected:
+        path = node['path']
+        b = path.replace(self.file_directory, '').count('/')
+
+        for entry in node['content']:
+            if entry[0] == 'file':
+                _, file, abspath, checking = entry
+                potentiostat = checking[2]
+                data = [potentiostat, checking[-1]['Unit'], abspath]
+                folder_name = os.path.basename(path)
+                if folder_name not in self.added_iv:
+                    self.added_iv[folder_name] = {}
+                self.added_iv[folder_name][file] = Device(
+                    path=abspath,
+                    measurement_device=potentiostat,
+                    encoding=checking[1],
+                    sweeps=checking[3]["Counts"],
+                    data=checking[3]["Data"],
+                    unit=checking[3]['Unit'],
+                    used_files=file,
+                )
+                self.table_frame.files_table.insert(parent=parent, index=tk.END, text=file, values=data,
+                                                    tags='file')
+            else:
+                sub_node = entry[1]
+                if sub_node['has devices']:
+                    abspath = sub_node['path']
                     if b == depth:  # Nested folders with the deep of one only
                         # allowed for the Processed folders
                         retry_reading_in_aging_mode = messagebox.askyesno('Waring!',
@@ -276,11 +283,13 @@ class IVProcessingMainClass(ctk.CTkFrame):
                         if retry_reading_in_aging_mode:
                             self.slide_frame.aging_mode_checkbox.toggle()
                         return
-                    oid = self.table_frame.files_table.insert(parent, 'end', text=file, open=False, tags='folder',
-                                                              values=['', '', abspath])
-                    self.process_directory(oid, abspath, is_root_call=False)
+                    oid = self.table_frame.files_table.insert(parent, 'end', text=sub_node['name'], open=False,
+                                                              tags='folder', values=['', '', abspath])
+                    self.process_directory(oid, sub_node, is_root_call=False)
         # Only run the following lines if it's the root call
         if is_root_call:
+            # One V and one I buffer per folder instead of a DataFrame per sweep, the not read sweeps stay as they are
+            SweepStore.pack_folders(self.added_iv, load=False)
             self.data_temp = self.detect_pixels()
             self.table_frame.construct_active_areas_entries(data=self.data_temp,
                                                             path_for_auto_aa_detect=self.file_directory,
@@ -376,22 +385,30 @@ class IVProcessingMainClass(ctk.CTkFrame):
                                                 f"because not enough CV data")
 
         self.start_time = time.time()
-        matched = CalculateIVParameters(parent=self, matched_devices=matched).return_data()
+        # The sweeps read on demand (or combined) since the scan
+        SweepStore.pack_folders(matched)
+        matched = CalculateIVParameters(parent=self, matched_devices=matched,
+                                        memo=self.parameter_memo).return_data()
+        # The data read on demand by the metadata-only scan are cached by now
+        self.parse_cache.flush()
+        self.parameter_memo.flush()
         iv_calculation_time = time.time() - self.start_time
         print('JV parameters have been calculated')
         print("--- %s seconds ---" % iv_calculation_time)
+        substrates = self.pixel_sorter_instance.return_sorted_dict() if self.pixel_sorter_instance else None
+        self.results = ResultsTable.from_devices(matched, substrates)
 
         filter_instance = FilterJVData(parent=self)
         if self.filter1 and self.pixel_sorter_instance:
             start_time = time.time()
-            matched = filter_instance.filter1(data=matched, substrates=self.pixel_sorter_instance.return_sorted_dict())
+            matched = filter_instance.filter1(data=matched, substrates=substrates, results=self.results)
             filter1_time = time.time() - start_time
             print('\nFilter 1 has been applied')
             print(f"--- {filter1_time} seconds ---")
 
         if self.filter2:
             start_time = time.time()
-            matched = filter_instance.filter2(data=matched)
+            matched = filter_instance.filter2(data=matched, results=self.results)
             filter2_time = time.time() - start_time
             print('\nFilter 2 has been applied')
             print(f"--- {filter2_time} seconds ---")
@@ -400,8 +417,8 @@ class IVProcessingMainClass(ctk.CTkFrame):
 
         if self.pixel_sorter_instance:
             start_time = time.time()
-            matched = PixelMerger(data=matched, parent=self,
-                                  substrates=self.pixel_sorter_instance.return_sorted_dict()).return_merged_data()
+            matched = PixelMerger(data=matched, parent=self, substrates=substrates,
+                                  results=self.results).return_merged_data()
             pixel_merger_time = time.time() - start_time
             self.sorted = True
             print('\nPixel merging has been completed')
@@ -0,0 +1,139 @@
+import mmap
+import re
+from typing import Dict, List
+
+import numpy as np
+
+MPR_MAGIC = b'BIO-LOGIC MODULAR FILE\x1a'.ljust(48) + b'\x00\x00\x00\x00'
+MODULE_MAGIC = b'MODULE'
+
+# Two layouts of the module header exist, the newer EC-Lab versions added the 'max length' and one unknown field
+MODULE_HEADER_V1 = np.dtype([('shortname', 'S10'), ('longname', 'S25'), ('length', '<u4'), ('version', '<u4'),
+                             ('date', 'S8')])
+MODULE_HEADER_V2 = np.dtype([('shortname', 'S10'), ('longname', 'S25'), ('max length', '<u4'), ('length', '<u4'),
+                             ('version', '<u4'), ('unknown', '<u4'), ('date', 'S8')])
+
+# Column IDs of the data module and the (name, type) of the corresponding values
+COLUMN_TYPES = {
+    4: ('time/s', '<f8'),
+    5: ('control/V/mA', '<f4'),
+    6: ('Ewe/V', '<f4'),
+    7: ('dQ/mA.h', '<f8'),
+    8: ('I/mA', '<f4'),
+    9: ('Ece/V', '<f4'),
+    11: ('<I>/mA', '<f8'),
+    13: ('(Q-Qo)/mA.h', '<f8'),
+    16: ('Analog IN 1/V', '<f4'),
+    19: ('control/V', '<f4'),
+    20: ('control/mA', '<f4'),
+    23: ('dQ/mA.h', '<f8'),
+    24: ('cycle number', '<f8'),
+    26: ('Rapp/Ohm', '<f4'),
+    39: ('I Range', '<u2'),
+    70: ('P/W', '<f4'),
+    76: ('<I>/mA', '<f4'),
+    131: ('Ns', '<u2'),
+    174: ('<Ewe>/V', '<f4'),
+}
+# These columns are bit flags, all of them are packed into a single byte
+FLAG_COLUMNS = {1: 'mode', 2: 'ox/red', 3: 'error', 21: 'control changes', 31: 'Ns changes', 65: 'counter inc.'}
+
+# Offset of the records in the data module, depending on the version of the module
+DATA_OFFSETS = {0: 100, 2: 405, 3: 406}
+
+
+class MprReader:
+    """
+    Reader of the binary EC-Lab (.mpr) files.
+
+    The file is memory-mapped and the records of the 'VMP data' module are viewed as a NumPy structured array, so no
+    text parsing takes place. Only the requested columns are copied out of the mapping.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: Path to the .mpr file.
+        """
+        self.path = path
+
+    @staticmethod
+    def read_module_header(buffer, position: int) -> tuple:
+        """
+        Decode the header of a module.
+
+        The version of the header layout is not stored in the file, so the older layout is tried first and the newer
+        one is used if the date field does not look like a date.
+
+        :param buffer: The mapped file.
+        :param position: Position right after the 'MODULE' magic.
+        :return: The decoded header as a dictionary and the position of the module data.
+        """
+        for header_type in (MODULE_HEADER_V1, MODULE_HEADER_V2):
+            if position + header_type.itemsize > len(buffer):
+                break
+            # A copy, so nothing keeps referring to the mapping
+            header = np.frombuffer(buffer, dtype=header_type, count=1, offset=position).copy()[0]
+            if re.fullmatch(rb'\d\d/\d\d/\d\d', header['date']):
+                return {name: header[name] for name in header_type.names}, position + header_type.itemsize
+        raise ValueError(f"Unknown layout of the module header at the byte {position}")
+
+    @staticmethod
+    def records_type(column_ids: List[int]) -> np.dtype:
+        """
+        Build the structured type of the data records.
+
+        :param column_ids: The column IDs in the order they are stored.
+        :return: The structured type, the flag columns are merged into a single 'flags' byte.
+        """
+        fields = []
+        for column_id in column_ids:
+            if column_id in FLAG_COLUMNS:
+                if ('flags', 'u1') not in fields:
+                    fields.append(('flags', 'u1'))
+            elif column_id in COLUMN_TYPES:
+                name, value_type = COLUMN_TYPES[column_id]
+                # The same quantity may appear twice, keep both but under unique names
+                while name in (field[0] for field in fields):
+                    name += ' '
+                fields.append((name, value_type))
+            else:
+                raise ValueError(f"Unknown column ID {column_id} in the EC-Lab data module")
+        return np.dtype(fields)
+
+    def read(self, columns: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Read the columns of the data module.
+
+        :param columns: Names of the columns to read (see COLUMN_TYPES). Missing columns are skipped.
+        :return: Dictionary mapping the column names found in the file to float arrays.
+        """
+        with open(self.path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if buffer[:len(MPR_MAGIC)] != MPR_MAGIC:
+                raise ValueError(f"{self.path} is not an EC-Lab binary file")
+
+            position = len(MPR_MAGIC)
+            while position < len(buffer):
+                if buffer[position:position + len(MODULE_MAGIC)] != MODULE_MAGIC:
+                    raise ValueError(f"Corrupted module at the byte {position} of {self.path}")
+                header, data_start = self.read_module_header(buffer, position + len(MODULE_MAGIC))
+                position = data_start + int(header['length'])
+                if header['shortname'].strip() != b'VMP data':
+                    continue
+
+                version = int(header['version'])
+                if version not in DATA_OFFSETS:
+                    raise ValueError(f"Unsupported version {version} of the data module in {self.path}")
+                n_points = int.from_bytes(buffer[data_start:data_start + 4], 'little')
+                n_columns = buffer[data_start + 4]
+                column_ids = np.frombuffer(buffer[data_start + 5:data_start + 5 + 2 * n_columns],
+                                           dtype='u1' if version == 0 else '<u2', count=n_columns).tolist()
+                records_type = self.records_type(column_ids)
+                records_start = data_start + DATA_OFFSETS[version]
+                if records_start + n_points * records_type.itemsize > len(buffer):
+                    raise ValueError(f"The data module of {self.path} is truncated")
+                records = np.frombuffer(buffer, dtype=records_type, count=n_points, offset=records_start)
+                # Copy the values out, the mapping is closed on return
+                result = {name: records[name].astype(float) for name in columns if name in records_type.names}
+                del records
+                return result
+        raise ValueError(f"No data module found in {self.path}")
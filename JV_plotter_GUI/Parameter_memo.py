@@ -0,0 +1,140 @@
+import hashlib
+import os
+import time
+from typing import Hashable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from JV_plotter_GUI.Batch_IV_engine import BatchIVEngine
+from JV_plotter_GUI.settings import settings
+
+# Bump it whenever BatchIVEngine.intermediates starts producing different values, so the outdated entries are not used
+ENGINE_VERSION = 1
+
+
+class ParameterMemo:
+    """
+    On-disk memo of the IV parameters which depend on the sweep data only (see BatchIVEngine.intermediate_columns).
+
+    An entry is keyed by a hash of the voltage and current arrays of a sweep, so re-running the same data with another
+    active area, light intensity or filter thresholds only repeats the cheap BatchIVEngine.scale, and the sweeps shared
+    with an earlier run are not recalculated. All the entries are kept in a single uncompressed .npz archive with the
+    keys, the values and the last use times as three arrays. When there are more entries than allowed, the least
+    recently used ones are dropped.
+    """
+    archive_name = 'parameter_memo.npz'
+
+    def __init__(self, directory: Optional[str] = None, max_entries: Optional[int] = None):
+        """
+        :param directory: (Optional) Directory to keep the memo in. Defaults to the one from the settings.
+        :param max_entries: (Optional) The largest number of the memoized sweeps. Defaults to the one from the settings.
+        """
+        memo_settings = settings['Parameter memo']
+        self.enabled = memo_settings['enabled']
+        self.directory = directory or memo_settings['directory'] or os.path.join(os.path.expanduser('~'),
+                                                                                  '.jv_processor')
+        self.max_entries = memo_settings['max_entries'] if max_entries is None else max_entries
+        self.modified = False
+        # {key: [values, last used]}
+        self.entries = self.load() if self.enabled else {}
+
+    def load(self) -> dict:
+        """
+        Load the memoized sweeps.
+
+        :return: Dictionary mapping the keys to [values, last used].
+        """
+        try:
+            with np.load(os.path.join(self.directory, self.archive_name)) as archive:
+                keys, values, last_used = archive['keys'], archive['values'], archive['last used']
+        except (OSError, KeyError, ValueError):
+            return {}
+        if values.ndim != 2 or values.shape[1] != len(BatchIVEngine.intermediate_columns):
+            return {}
+        return {key: [row, used] for key, row, used in zip(keys.tolist(), values, last_used.tolist())}
+
+    @staticmethod
+    def make_key(voltage: np.ndarray, current: np.ndarray, interpolate: bool = False) -> str:
+        """
+        Build the memo key of a sweep.
+
+        :param voltage: Voltage of the sweep.
+        :param current: Current of the sweep.
+        :param interpolate: (Optional) Whether the MPP and Voc are interpolated, see BatchIVEngine.
+        :return: Hexadecimal key built from the bytes of both arrays (as float64), the engine version and options.
+        """
+        key = hashlib.sha1(f'{len(voltage)}|{ENGINE_VERSION}|{int(interpolate)}|'.encode('utf-8'))
+        key.update(np.ascontiguousarray(voltage, dtype=float).tobytes())
+        key.update(np.ascontiguousarray(current, dtype=float).tobytes())
+        return key.hexdigest()
+
+    @staticmethod
+    def calculate(voltages: List[np.ndarray], currents: List[np.ndarray], shards: Optional[List[Hashable]] = None,
+                  workers: Optional[int] = None, interpolate: bool = False) -> pd.DataFrame:
+        """
+        Calculate the intermediates of the sweeps, in one batch or sharded (see BatchIVEngine.sharded_intermediates).
+        """
+        if shards is None:
+            return BatchIVEngine(voltages, currents, interpolate=interpolate).intermediates()
+        return BatchIVEngine.sharded_intermediates(voltages, currents, shards, workers=workers, interpolate=interpolate)
+
+    def intermediates(self, voltages: List[np.ndarray], currents: List[np.ndarray],
+                      shards: Optional[List[Hashable]] = None, workers: Optional[int] = None,
+                      interpolate: bool = False) -> pd.DataFrame:
+        """
+        Return BatchIVEngine.intermediates of the sweeps, calculating only the ones not memoized yet.
+
+        :param voltages: Voltage of every sweep.
+        :param currents: Current of every sweep, in A.
+        :param shards: (Optional) Label of the shard of every sweep, to calculate the missing sweeps sharded.
+        :param workers: (Optional) Number of worker processes for the sharded calculation.
+        :param interpolate: (Optional) Whether to interpolate the MPP and Voc, see BatchIVEngine.
+        :return: The same table BatchIVEngine.intermediates returns.
+        """
+        if not self.enabled:
+            return self.calculate(voltages, currents, shards, workers, interpolate)
+        keys = [self.make_key(voltage, current, interpolate) for voltage, current in zip(voltages, currents)]
+        missing = [index for index, key in enumerate(keys) if key not in self.entries]
+        if missing:
+            computed = self.calculate([voltages[index] for index in missing], [currents[index] for index in missing],
+                                      None if shards is None else [shards[index] for index in missing], workers,
+                                      interpolate)
+            for index, row in zip(missing, computed.to_numpy(dtype=float)):
+                self.entries[keys[index]] = [row, 0.0]
+
+        now = time.time()
+        values = np.empty((len(keys), len(BatchIVEngine.intermediate_columns)))
+        for index, key in enumerate(keys):
+            entry = self.entries[key]
+            entry[1] = now
+            values[index] = entry[0]
+        self.modified = self.modified or bool(keys)
+
+        table = pd.DataFrame(values, columns=BatchIVEngine.intermediate_columns)
+        # Memoized as a float, like the rest of the values
+        table['Voc fit failed'] = table['Voc fit failed'].astype(bool)
+        return table
+
+    def flush(self) -> None:
+        """
+        Apply the limit of entries and write the memo to the disk.
+        """
+        if not self.enabled or not self.modified:
+            return
+        if len(self.entries) > self.max_entries:
+            newest = sorted(self.entries, key=lambda k: self.entries[k][1], reverse=True)[:self.max_entries]
+            self.entries = {key: self.entries[key] for key in newest}
+        os.makedirs(self.directory, exist_ok=True)
+        archive_path = os.path.join(self.directory, self.archive_name)
+        width = len(BatchIVEngine.intermediate_columns)
+        arrays = {'keys': np.array(list(self.entries), dtype='U40'),
+                  'values': np.array([entry[0] for entry in self.entries.values()]).reshape(-1, width),
+                  'last used': np.array([entry[1] for entry in self.entries.values()], dtype=float)}
+        try:
+            with open(f'{archive_path}.tmp', 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(f'{archive_path}.tmp', archive_path)
+        except OSError:
+            return
+        self.modified = False
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import time
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from JV_plotter_GUI.settings import settings
+
+# Bump it whenever a reader starts producing different data, so the outdated entries are not used anymore
+PARSER_VERSION = 5
+
+
+class ParseCache:
+    """
+    On-disk cache of the parsed measurement files.
+
+    Every parsed file is stored as an uncompressed .npz archive holding one (N, 2) array [V, I] per sweep, while the
+    rest of the check_file result (encoding, potentiostat, unit, sweep counts) is kept in a JSON index. An entry is
+    valid only for the same path, size, modification time and PARSER_VERSION. Files which were checked but turned out
+    not to be potentiostat files are cached as well, without an archive, and so are the results of the metadata-only
+    scan until their data are loaded.
+    The entries of the deleted files are dropped, and when the archives exceed the size limit or the index exceeds
+    the entry limit, the least recently used entries are evicted.
+    """
+    index_name = 'index.json'
+
+    def __init__(self, directory: Optional[str] = None, max_size_mb: Optional[float] = None,
+                 max_entries: Optional[int] = None):
+        """
+        :param directory: (Optional) Directory to keep the cache in. Defaults to the one from the settings.
+        :param max_size_mb: (Optional) Size limit of the cache in MB. Defaults to the one from the settings.
+        :param max_entries: (Optional) Limit of the number of the cached files, including the ones without an archive.
+                            Defaults to the one from the settings.
+        """
+        cache_settings = settings['Parse cache']
+        self.enabled = cache_settings['enabled']
+        self.directory = directory or cache_settings['directory'] or os.path.join(os.path.expanduser('~'),
+                                                                                   '.jv_processor', 'parse_cache')
+        max_size_mb = cache_settings['max_size_mb'] if max_size_mb is None else max_size_mb
+        self.max_size = int(max_size_mb * 1024 ** 2)
+        self.max_entries = cache_settings['max_entries'] if max_entries is None else max_entries
+        self.modified = False
+        self.index = self.load_index() if self.enabled else {}
+        self.keys_by_path = {entry['path']: key for key, entry in self.index.items()}
+
+    def load_index(self) -> dict:
+        """
+        Load the index of the cached files.
+
+        :return: Dictionary mapping the cache keys to the metadata of the cached files.
+        """
+        try:
+            with open(os.path.join(self.directory, self.index_name), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def make_key(path: str, stat: os.stat_result) -> str:
+        """
+        Build the cache key of a file.
+
+        :param path: Path to the file.
+        :param stat: Result of os.stat for the file.
+        :return: Hexadecimal key built from the path, size, modification time and the parser version.
+        """
+        key = f'{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{PARSER_VERSION}'
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def archive_path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.npz')
+
+    def get(self, path: str, load_data: bool = True) -> Optional[tuple]:
+        """
+        Return the cached check_file result for a file.
+
+        :param path: Path to the file.
+        :param load_data: (Optional) Whether to load the sweep data. If False, the archive is not opened and 'Data'
+                          holds only the list of the sweep names.
+        :return: The same tuple check_file returns, or None if the file is not cached or was changed since.
+        """
+        if not self.enabled:
+            return None
+        try:
+            key = self.make_key(path, os.stat(path))
+        except OSError:
+            return None
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        if entry['potentiostat'] is None:
+            result = False, entry['encoding'], None, None
+        elif not load_data:
+            sweeps_data = {'Counts': dict(entry['counts']), 'Data': list(entry['sweeps']), 'Unit': entry['unit']}
+            result = True, entry['encoding'], entry['potentiostat'], sweeps_data
+        else:
+            try:
+                with np.load(self.archive_path(key)) as archive:
+                    data = {sweep: pd.DataFrame(archive[sweep], columns=['V', 'I']) for sweep in entry['sweeps']}
+            except (OSError, KeyError, ValueError):
+                self.remove(key)
+                return None
+            sweeps_data = {'Counts': dict(entry['counts']), 'Data': data, 'Unit': entry['unit']}
+            result = True, entry['encoding'], entry['potentiostat'], sweeps_data
+        entry['last used'] = time.time()
+        self.modified = True
+        return result
+
+    def put(self, path: str, result: tuple) -> None:
+        """
+        Store the check_file result of a file.
+
+        :param path: Path to the file.
+        :param result: The tuple returned by check_file.
+        """
+        if not self.enabled:
+            return
+        try:
+            key = self.make_key(path, os.stat(path))
+        except OSError:
+            return
+        path = os.path.abspath(path)
+        # The file has changed, so the old entry is not valid anymore
+        if path in self.keys_by_path and self.keys_by_path[path] != key:
+            self.remove(self.keys_by_path[path])
+
+        matched, encoding, potentiostat, sweeps_data = result
+        entry = {'path': path, 'encoding': encoding, 'potentiostat': potentiostat if matched else None,
+                 'unit': None, 'counts': None, 'sweeps': [], 'bytes': 0, 'last used': time.time()}
+        if matched:
+            entry.update({'unit': sweeps_data.get('Unit'), 'counts': sweeps_data['Counts'],
+                          'sweeps': list(sweeps_data['Data'])})
+        # A metadata-only result (see LazySweepData) has no archive, it is written once the data are loaded
+        if matched and getattr(sweeps_data['Data'], 'loaded', True):
+            os.makedirs(self.directory, exist_ok=True)
+            arrays = {sweep: df[['V', 'I']].to_numpy(dtype=float) for sweep, df in sweeps_data['Data'].items()}
+            try:
+                with open(self.archive_path(key), 'wb') as f:
+                    np.savez(f, **arrays)
+            except OSError:
+                return
+            entry['bytes'] = os.path.getsize(self.archive_path(key))
+        self.index[key] = entry
+        self.keys_by_path[path] = key
+        self.modified = True
+
+    def remove(self, key: str) -> None:
+        """
+        Remove an entry and its archive from the cache.
+
+        :param key: The cache key.
+        """
+        entry = self.index.pop(key, None)
+        if entry is not None and self.keys_by_path.get(entry['path']) == key:
+            del self.keys_by_path[entry['path']]
+        try:
+            os.remove(self.archive_path(key))
+        except OSError:
+            pass
+        self.modified = True
+
+    def evict(self) -> None:
+        """
+        Remove the entries of the files which do not exist anymore, then the least recently used entries until the
+        cache fits into the size and entry limits.
+        """
+        for key in [key for key, entry in self.index.items() if not os.path.exists(entry['path'])]:
+            self.remove(key)
+        total_size = sum(entry['bytes'] for entry in self.index.values())
+        entries = len(self.index)
+        for key in sorted(self.index, key=lambda k: self.index[k]['last used']):
+            if total_size <= self.max_size and entries <= self.max_entries:
+                break
+            total_size -= self.index[key]['bytes']
+            entries -= 1
+            self.remove(key)
+
+    def flush(self) -> None:
+        """
+        Apply the size limit and write the index to the disk.
+        """
+        if not self.enabled or not self.modified:
+            return
+        self.evict()
+        os.makedirs(self.directory, exist_ok=True)
+        index_path = os.path.join(self.directory, self.index_name)
+        try:
+            with open(f'{index_path}.tmp', 'w') as f:
+                json.dump(self.index, f)
+            os.replace(f'{index_path}.tmp', index_path)
+        except OSError:
+            return
+        self.modified = False
@@ -1,26 +1,40 @@
-from typing import Any, List, Dict
+import warnings
+from typing import Any, List, Dict, Optional
 
 import numpy as np
-import pandas as pd
+
+from JV_plotter_GUI.Device_records import Device, ParameterSet
+from JV_plotter_GUI.Results_table import ResultsTable
+from JV_plotter_GUI.Substrate_statistics import SubstrateStatistics
+from JV_plotter_GUI.Sweep_store import SweepView
+from JV_plotter_GUI.settings import settings
 
 
 class PixelMerger:
-    def __init__(self, data: Dict[str, Any], substrates: Dict[str, List[str]], parent):
+    def __init__(self, data: Dict[str, Any], substrates: Dict[str, List[str]], parent,
+                 results: Optional[ResultsTable] = None):
         """
         Initialize the PixelMerger class.
 
         :param parent: An instance of the main ctk app, used for integration with a custom tkinter interface.
         :param data: A dictionary containing pixel data.
         :param substrates: A dictionary where each key is a substrate name, and its value is a list of pixel names.
+        :param results: (Optional) The results table of the data, the substrate statistics are calculated from it.
+                        Built from the data if not given.
         """
         self.parent = parent
         self.data = data
         self.substrates = substrates
         self.merged_data = {}
         self.stat = self.parent.stat
+        self.spread = settings['Sweep averaging']['spread']
+        # All the metrics of all the substrates at once
+        results = results if results is not None else ResultsTable.from_devices(data, substrates)
+        self.statistics = SubstrateStatistics(results, substrates)
+        self.substrate_parameters = self.statistics.parameters(self.stat)
         self.merge_substrates()
 
-    def average_parameters(self, parameter_dicts: List[Dict[str, Any]]) -> Dict[str, float]:
+    def average_parameters(self, parameter_dicts: List[Dict[str, Any]]) -> ParameterSet:
         """
         Calculate the average and various error metrics (standard deviation, mean absolute error, mean squared error,
         root mean squared error, mean absolute percentage error, median absolute deviation) for parameters across a set
@@ -40,7 +54,7 @@ class PixelMerger:
             for key, value in param_dict.items():
                 param_values[key].append(value)
 
-        calculated_params = {}
+        calculated_params = ParameterSet()
         for key, values in param_values.items():
             values = np.array(values)
             mean_value = np.mean(values)
@@ -68,6 +82,31 @@ class PixelMerger:
             calculated_params[error_key] = error_value
         return calculated_params
 
+    def nan_errors(self, values: np.ndarray, mean_values: np.ndarray) -> np.ndarray:
+        """
+        The selected error metric (see average_parameters) of every row of the values, ignoring the NaNs.
+
+        :param values: Array (points, pixels), NaN where a pixel has no value.
+        :param mean_values: The mean of every row.
+        :return: The error of every row, NaN where it cannot be calculated (e.g. std_dev of a single value).
+        """
+        deviations = values - mean_values[:, None]
+        with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if self.stat == 'std_dev':
+                return np.nanstd(values, axis=1, ddof=1)  # Sample standard deviation
+            elif self.stat == 'mae':
+                return np.nanmean(np.abs(deviations), axis=1)  # Mean Absolute Error
+            elif self.stat == 'mse':
+                return np.nanmean(deviations ** 2, axis=1)  # Mean Squared Error
+            elif self.stat == 'rmse':
+                return np.sqrt(np.nanmean(deviations ** 2, axis=1))  # Root Mean Squared Error
+            elif self.stat == 'mape':
+                return np.nan_to_num(np.nanmean(np.abs(deviations / values), axis=1) * 100)
+            elif self.stat == 'mad':
+                return np.nanmedian(np.abs(values - np.nanmedian(values, axis=1)[:, None]), axis=1)
+        raise ValueError(f"Unknown stat: {self.stat}")
+
     @staticmethod
     def check_consistency(key: str, pixels: List[Dict[str, Any]]) -> Any:
         """
@@ -82,15 +121,22 @@ class PixelMerger:
             raise ValueError(f"Inconsistent values for '{key}' across pixels.")
         return values.pop()
 
-    def merge_pixels(self, folder_name: str, substrate_pixels: List[str]) -> Dict[str, Any]:
+    def merge_pixels(self, folder_name: str, substrate_pixels: List[str],
+                     substrate_name: Optional[str] = None) -> Device:
         """
         Merge all pixel data for a given substrate.
 
         :param folder_name: The date (usually) string which represents the top-level key in data.
         :param substrate_pixels: A list of pixel names that belong to the same substrate.
-        :return: A dictionary containing merged data for the substrate.
+        :param substrate_name: (Optional) The name of the substrate, to take the averaged parameters from the
+                               statistics of all the substrates. If not given, they are calculated for this one.
+        :return: The record (see Device) of the merged substrate.
+
+        Speed (10 folders, 2 substrates of 6 pixels each, 150-200 points per sweep):
+        - A loop over the voltage indexes: ~1.3 seconds
+        - NaN-padded array and np.nanmean: ~0.01 seconds
         """
-        merged = {'Parameters': {}, 'data': {}}
+        merged = Device(parameters={}, data={})
         keys_to_check = [
             'Active area (cm²)', 'Distance to light source (mm)',
             'Light intensity (W/cm²)', 'encoding', 'measurement device', 'unit'
@@ -102,6 +148,9 @@ class PixelMerger:
         # Aggregate sweeps data by averaging parameters.
         sweep_types = ['Forward', 'Reverse', 'Average']
         for sweep_type in sweep_types:
+            if (folder_name, substrate_name, sweep_type) in self.substrate_parameters:
+                merged['Parameters'][sweep_type] = self.substrate_parameters[(folder_name, substrate_name, sweep_type)]
+                continue
             parameters = [date_data[pixel_name]['Parameters'][sweep_type] for pixel_name in substrate_pixels if
                           sweep_type in date_data[pixel_name]['Parameters']]
             merged['Parameters'][sweep_type] = self.average_parameters(parameters)
@@ -122,42 +171,36 @@ class PixelMerger:
 
         # Process and average IV data for each sweep type
         for sweep_type in all_sweep_types:
-            sweep_data_frames = []
+            sweeps = []
             for pixel_name in substrate_pixels:
                 pixel_data = self.data[folder_name][pixel_name]
                 if sweep_type in pixel_data['data']:
-                    sweep_data_frames.append(pixel_data['data'][sweep_type])
-            if sweep_data_frames:
+                    sweeps.append(pixel_data['data'][sweep_type])
+            if sweeps:
 
                 # Check if the lengths of 'V' are different
-                lengths = [len(df) for df in sweep_data_frames]
+                lengths = [len(sweep) for sweep in sweeps]
                 if len(set(lengths)) != 1:
-                    # Find the index of the DataFrame with the longest 'V'
-                    longest_df_index = lengths.index(max(lengths))
-                    v_values = sweep_data_frames[longest_df_index]['V']
+                    # Find the index of the sweep with the longest 'V'
+                    longest_index = lengths.index(max(lengths))
+                    v_values = np.array(sweeps[longest_index]['V'])
                 else:
-                    # If all lengths are the same, use 'V' from the first DataFrame
-                    v_values = sweep_data_frames[0]['V']
-
-                # Create a new DataFrame with the longest 'V'
-                merged['data'][sweep_type] = pd.DataFrame({'V': v_values})
-                average_i_values = []
-
-                # Iterate over each index of the longest 'V' series
-                for index in range(len(v_values)):
-                    i_values = []
+                    # If all lengths are the same, use 'V' from the first sweep
+                    v_values = np.array(sweeps[0]['V'])
 
-                    # Collect 'I' values for this index from all DataFrames, if available
-                    for df in sweep_data_frames:
-                        if index < len(df):
-                            i_values.append(df.iloc[index]['I'])
+                # The currents of the pixels side by side, NaN-padded to the longest 'V'
+                currents = np.full((len(v_values), len(sweeps)), np.nan)
+                for column, sweep in enumerate(sweeps):
+                    currents[:len(sweep), column] = sweep['I']
 
-                    # Compute the average of 'I' values, if available
-                    if i_values:
-                        average_i_values.append(np.mean(i_values))
+                # The average 'I' at every index, over the pixels which have it
+                average_i_values = np.nanmean(currents, axis=1)
 
-                # Assign the average 'I' values to the merged DataFrame
-                merged['data'][sweep_type]['I'] = average_i_values
+                # The merged sweep with the longest 'V' and the average 'I'
+                merged['data'][sweep_type] = SweepView(v_values, average_i_values.astype(v_values.dtype))
+                if self.spread:
+                    merged.setdefault('I spread', {})[sweep_type] = self.nan_errors(currents,
+                                                                                   average_i_values).tolist()
 
         # Merge 'Used files' into a list, ensuring no duplicates.
         used_files = [date_data[pixel_name]['Used files'] for pixel_name in substrate_pixels if
@@ -175,7 +218,8 @@ class PixelMerger:
             for substrate_name, pixel_group in self.substrates.items():
                 substrate_pixels = {name: devices[name] for name in pixel_group if name in devices}
                 if substrate_pixels:
-                    merged_for_date[substrate_name] = self.merge_pixels(folder_name, list(substrate_pixels.keys()))
+                    merged_for_date[substrate_name] = self.merge_pixels(folder_name, list(substrate_pixels.keys()),
+                                                                        substrate_name)
 
             # Iterate through the devices in each folder
             for device_name, device_data in devices.items():
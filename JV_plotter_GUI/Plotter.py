@@ -201,10 +201,10 @@ class DevicePlotter:
                 row = 1
                 for sweep_name, sweep_data in device_data['data'].items():
                     # Write the data to the worksheet
-                    for _, row_data in sweep_data.iterrows():
-                        ws.write(row, 1, row_data['V'])
-                        power = row_data['I'] * row_data['V']
-                        current_density = 1000 * row_data['I'] / device_data['Active area (cm²)']
+                    for voltage, current in zip(sweep_data['V'].tolist(), sweep_data['I'].tolist()):
+                        ws.write(row, 1, voltage)
+                        power = current * voltage
+                        current_density = 1000 * current / device_data['Active area (cm²)']
                         ws.write(row, 2, power)
                         ws.write(row, 0, current_density)
                         row += 1
@@ -1,9 +1,15 @@
+import locale
 import os
+from collections.abc import MutableMapping
+from typing import List, Optional
 
-import chardet
+import numpy as np
 import pandas as pd
+from CTkMessagebox import CTkMessagebox
 
 from JV_plotter_GUI.Data_Reader import IVDataReader
+from JV_plotter_GUI.Encoding_resolver import EncodingResolver, encoding_resolver
+from JV_plotter_GUI.instruments import parallel_map
 
 
 class PotentiostatFileChecker:
@@ -11,10 +17,20 @@ class PotentiostatFileChecker:
     Class to check if a file matches one of the specified potentiostat types.
     """
 
-    def __init__(self, parent, potentiostat_choice='All'):
+    def __init__(self, parent, potentiostat_choice='All', cache=None, metadata_only=False,
+                 resolver: Optional[EncodingResolver] = None):
         """
         Initialize PotentiostatFileChecker with a dictionary mapping file extensions to potentiostat types and their
          identifying characteristics.
+
+        :param parent: The instance the checker was called from. None when running in a worker process, then the
+                       messages are collected in self.messages instead of being shown.
+        :param potentiostat_choice: Potentiostat to look for, or 'All'.
+        :param cache: (Optional) ParseCache instance to reuse the results for the files which were not changed.
+        :param metadata_only: (Optional) Keep only the current unit and the sweep counts of the files, the sweep data
+                              are read on the first access (see LazySweepData).
+        :param resolver: (Optional) EncodingResolver to detect the encodings with. Defaults to the one shared by the
+                         process.
         """
         self.parent = parent
         self.potentiostat_dict = {
@@ -22,52 +38,239 @@ class PotentiostatFileChecker:
             '.csv': {'PalmSens4': "Cyclic Voltammetry: CV i vs E"},
             '.txt': {'SMU': "[0, 0, 0]"},
             '.mpt': {'SP-150e': 'EC-Lab ASCII FILE'},
+            # Binary files are recognized by the bytes they start with
+            '.mpr': {'SP-150e': b'BIO-LOGIC MODULAR FILE'},
             # To add a new file extension, add a new entry like this:
             # '.new_extension': {'new_potentiostat': "new text to find"},
         }
         self.encoding = None
         self.potentiostat_choice = potentiostat_choice
+        self.cache = cache
+        self.metadata_only = metadata_only
+        self.resolver = resolver or encoding_resolver
+        self.messages = []
+        self.exit_requested = False
 
-    def check_file(self, file):
+    def show_message(self, **kwargs) -> None:
         """
-        Checks a file to determine if it matches one of the potentiostat types.
+        Show a CTkMessagebox, or keep its arguments if there is no GUI (worker process).
+
+        :param kwargs: Arguments of the CTkMessagebox.
+        """
+        if self.parent is None:
+            self.messages.append(kwargs)
+        else:
+            CTkMessagebox(**kwargs)
+
+    def exit(self) -> None:
+        """
+        Close the application, or only remember the request if there is no GUI (worker process).
+        """
+        if self.parent is None:
+            self.exit_requested = True
+        else:
+            self.parent.exit()
+
+    def accepted_extension(self, file) -> Optional[str]:
+        """
+        Return the extension of a file if it may belong to the chosen potentiostat(s).
 
         :param file: The file to check.
-        :return: If the file is identified, a tuple with (True, encoding_used, potentiostat_type, number of sweeps).
-                 If the file is not identified, a tuple with (False, encoding_used, None, None).
+        :return: The file extension, or None if the file should be skipped.
         """
         filename, file_extension = os.path.splitext(file)
         if self.potentiostat_choice != 'All':
             # Skip files that do not have an extension corresponding to the chosen potentiostat
             file_extensions = [ext for ext, pots in self.potentiostat_dict.items() if self.potentiostat_choice in pots]
             if file_extension not in file_extensions:
-                return False, None, None, None
+                return None
 
         if file_extension not in self.potentiostat_dict:
-            return False, None, None, None  # Skip files with non-matching extensions
+            return None  # Skip files with non-matching extensions
+        return file_extension
+
+    def check_files(self, files: List[str], workers: Optional[int] = None) -> List[tuple]:
+        """
+        Check many files at once. The files which are not in the cache are classified and parsed in a process pool.
+
+        :param files: The files to check.
+        :param workers: (Optional) Number of worker processes, see parallel_map.
+        :return: List of check_file results in the same order as the files.
+        """
+        results = [None] * len(files)
+        tasks, task_indices = [], []
+        for index, file in enumerate(files):
+            file_extension = self.accepted_extension(file)
+            if file_extension is None:
+                results[index] = False, None, None, None
+                continue
+            cached = self.cached_result(file)
+            if cached is not None:
+                results[index] = cached
+                continue
+            tasks.append((file, file_extension, self.potentiostat_choice, self.metadata_only))
+            task_indices.append(index)
+
+        for index, task, (packed_result, messages, exit_requested) in zip(
+                task_indices, tasks, parallel_map(classify_in_worker, tasks, workers=workers)):
+            result = self.unpack_result(packed_result)
+            if result[0] and result[1] != 'binary':
+                # Teach the profiles of this process what the workers found
+                self.resolver.learn(task[0], result[2], result[1])
+            if result[0] and isinstance(result[3]['Data'], LazySweepData):
+                result[3]['Data'].cache = self.cache
+            results[index] = result
+            if self.cache is not None:
+                self.cache.put(task[0], result)
+            for message in messages:
+                self.show_message(**message)
+            if exit_requested:
+                self.exit()
+        return results
 
-        # Detect encoding using chardet
+    def cached_result(self, file) -> Optional[tuple]:
+        """
+        Look a file up in the parse cache.
+
+        :param file: The file to look up.
+        :return: The cached check_file result, or None if there is no cache or the file is not cached.
+        """
+        if self.cache is None:
+            return None
+        cached = self.cache.get(file, load_data=not self.metadata_only)
+        if cached is not None and cached[0] and self.metadata_only:
+            matched, encoding, potentiostat, sweeps_data = cached
+            cached = matched, encoding, potentiostat, {**sweeps_data,
+                                                       'Data': LazySweepData(sweeps_data['Data'], file, self.cache)}
+        return cached
+
+    @staticmethod
+    def pack_result(result: tuple) -> tuple:
+        """
+        Replace the sweep DataFrames of a check_file result with plain (N, 2) [V, I] arrays, which are cheap to pickle.
+        """
+        matched, encoding, potentiostat, sweeps_data = result
+        if not matched or isinstance(sweeps_data['Data'], LazySweepData):
+            return result
+        arrays = {sweep: df[['V', 'I']].to_numpy(dtype=float) for sweep, df in sweeps_data['Data'].items()}
+        return matched, encoding, potentiostat, {**sweeps_data, 'Data': arrays}
+
+    @staticmethod
+    def unpack_result(result: tuple) -> tuple:
+        """
+        Restore the sweep DataFrames of a result packed with pack_result.
+        """
+        matched, encoding, potentiostat, sweeps_data = result
+        if not matched or isinstance(sweeps_data['Data'], LazySweepData):
+            return result
+        data = {sweep: pd.DataFrame(array, columns=['V', 'I']) for sweep, array in sweeps_data['Data'].items()}
+        return matched, encoding, potentiostat, {**sweeps_data, 'Data': data}
+
+    def check_file(self, file):
+        """
+        Checks a file to determine if it matches one of the potentiostat types.
+
+        :param file: The file to check.
+        :return: If the file is identified, a tuple with (True, encoding_used, potentiostat_type, number of sweeps).
+                 If the file is not identified, a tuple with (False, encoding_used, None, None).
+        """
+        file_extension = self.accepted_extension(file)
+        if file_extension is None:
+            return False, None, None, None
+
+        cached = self.cached_result(file)
+        if cached is not None:
+            self.encoding = cached[1]
+            return cached
+        result = self.classify(file, file_extension)
+        if self.cache is not None:
+            self.cache.put(file, result)
+        return result
+
+    def classify(self, file, file_extension):
+        """
+        Read a file and parse it if it matches one of the potentiostat types.
+
+        :param file: The file to check.
+        :param file_extension: The extension of the file.
+        :return: The same tuple as check_file returns.
+        """
+        signatures = self.potentiostat_dict[file_extension]
+        if all(isinstance(target, bytes) for target in signatures.values()):
+            # Binary file: no encoding to detect, only the magic bytes are read here and the reader maps the file itself
+            self.encoding = 'binary'
+            with open(file, 'rb') as f:
+                magic = f.read(max(len(target) for target in signatures.values()))
+            for potentiostat, target in signatures.items():
+                if magic.startswith(target):
+                    sweeps_data = self.detect_iv_sweeps(file, potentiostat)
+                    return True, self.encoding, potentiostat, sweeps_data
+            return False, self.encoding, None, None
+
+        # Read the file only once: the same bytes are used for the encoding detection, the signature lookup
+        # and finally handed over to the IVDataReader
         with open(file, 'rb') as f:
-            result = chardet.detect(f.read(4096))  # Check encoding of the first 4096 bytes
-        self.encoding = result['encoding']
-
-        for potentiostat, target_text in self.potentiostat_dict[file_extension].items():
-            with open(file, 'r', encoding=self.encoding) as f:
-                for i, line in enumerate(f):
-                    if i >= 100:  # limit the number of lines read to 100
-                        break
-                    if target_text in line:
-                        sweeps_data = self.detect_iv_sweeps(file, potentiostat)
-                        return True, self.encoding, potentiostat, sweeps_data
+            raw = f.read()
+        # The encoding profile of the directory, or chardet on the first 4096 bytes
+        self.encoding = self.resolver.resolve(file, raw)
+        text = self.decode(raw)
+        if text is None:
+            return False, self.encoding, None, None
+        # Universal newlines, the same as opening the file in the text mode
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+        head = self.head_lines(text, 100)  # limit the number of lines to look through to 100
+
+        for potentiostat, target_text in signatures.items():
+            if target_text in head:
+                self.resolver.learn(file, potentiostat, self.encoding)
+                sweeps_data = self.detect_iv_sweeps(file, potentiostat, buffer=text)
+                return True, self.encoding, potentiostat, sweeps_data
 
         # If we got this far, the file didn't match any potentiostat
         return False, self.encoding, None, None
 
-    def detect_iv_sweeps(self, file, potentiostat):
+    def decode(self, raw: bytes) -> Optional[str]:
+        """
+        Decode a file with the detected encoding. If nothing was detected or the file does not decode with it, the
+        default encoding of open() (the locale one) is tried, which the files used to be read with. self.encoding is
+        set to the encoding that worked.
+
+        :param raw: Content of the file.
+        :return: The decoded content, or None if neither encoding decodes the file.
+        """
+        for encoding in (self.encoding, locale.getpreferredencoding(False)):
+            if encoding is None:
+                continue
+            try:
+                text = raw.decode(encoding)
+            except (LookupError, UnicodeDecodeError):
+                continue
+            self.encoding = encoding
+            return text
+        return None
+
+    @staticmethod
+    def head_lines(text: str, number_of_lines: int) -> str:
+        """
+        Return the first lines of a decoded file.
+
+        :param text: The decoded content of a file.
+        :param number_of_lines: Number of lines to keep.
+        :return: The beginning of the text holding at most number_of_lines lines.
+        """
+        position = -1
+        for _ in range(number_of_lines):
+            position = text.find('\n', position + 1)
+            if position == -1:
+                return text
+        return text[:position]
+
+    def detect_iv_sweeps(self, file, potentiostat, buffer=None):
         """
         Detect the number of IV sweeps and their direction based on sign changes in a column of a dataframe.
         :param file: Path to IV data
         :param potentiostat: Type of the potentiostat
+        :param buffer: (Optional) Already decoded content of the file, so it is not read from the disk again
         :return: Dictionary containing:
                  - "Counts": Dictionary with counts for:
                      - "Total Sweeps": Integer count of total sweeps
@@ -80,53 +283,126 @@ class PotentiostatFileChecker:
                      - "4_Reverse": Data for the second detected reverse sweep
                      - (and so on...)
         """
-        df, unit = IVDataReader(self, file, potentiostat, self.encoding).read()
+        df, unit = IVDataReader(self, file, potentiostat, self.encoding, buffer=buffer).read()
 
         if len(df) < 2:
             return {"Counts": {"Total Sweeps": 0, "Forward Sweeps": 0, "Reverse Sweeps": 0}, "Data": {}}
 
-        sweeps_data = []
-        current_sweep_data = [{'V': df['V'].iloc[0], 'I': df['I'].iloc[0]}]
-
-        # Determine the initial direction based on the first two data points
-        current_direction = "increasing" if df['V'].iloc[1] > df['V'].iloc[0] else "decreasing"
-        for idx in range(1, len(df)):
-            current_v = df['V'].iloc[idx]
-            previous_v = df['V'].iloc[idx - 1]
-
-            # Determine the "local" direction
-            local_direction = "increasing" if current_v > previous_v else "decreasing"
-
-            if local_direction != current_direction:
-                sweeps_data.append(pd.DataFrame(current_sweep_data))
-                current_sweep_data = [{'V': current_v, 'I': df['I'].iloc[idx]}]
-                current_direction = local_direction
-            else:
-                current_sweep_data.append({'V': current_v, 'I': df['I'].iloc[idx]})
+        voltage = df['V'].to_numpy(dtype=float)
+        current = df['I'].to_numpy(dtype=float)
+        sweeps = self.split_sweeps(voltage)
 
-        # Append the final sweep
-        sweeps_data.append(pd.DataFrame(current_sweep_data))
+        counts = {"Total Sweeps": len(sweeps), "Forward Sweeps": 0, "Reverse Sweeps": 0}
+        for key, _, _ in sweeps:
+            counts["Forward Sweeps" if key.endswith("Forward") else "Reverse Sweeps"] += 1
+        if self.metadata_only:
+            # Only the sweep names are known now, the data are read again when they are needed
+            data = LazySweepData([key for key, _, _ in sweeps], file)
+        else:
+            # Views of the original arrays, no copying
+            data = {key: pd.DataFrame({'V': voltage[start:end], 'I': current[start:end]}, copy=False)
+                    for key, start, end in sweeps}
+        return {"Counts": counts, "Data": data, 'Unit': unit}
 
-        forward_count = sum(1 for df in sweeps_data if len(df) > 1 and df['V'].iloc[1] > df['V'].iloc[0])
+    @staticmethod
+    def split_sweeps(voltage: np.ndarray) -> List[tuple]:
+        """
+        Split the voltage into sweeps at the points where the direction of the voltage steps changes.
 
-        reverse_count = len(sweeps_data) - forward_count
+        :param voltage: The voltage values.
+        :return: List of tuples (sweep name, first index, index after the last one) in the order of the measurement.
+                 Forward sweeps are named 1_Forward, 3_Forward, ... and reverse sweeps 2_Reverse, 4_Reverse, ...
+        """
+        # Direction of every step ("increasing" or "decreasing"); a new sweep starts at the point where the direction
+        # of the step leading to it differs from the previous step
+        increasing = voltage[1:] > voltage[:-1]
+        sweep_starts = np.flatnonzero(increasing[1:] != increasing[:-1]) + 2
+        bounds = np.concatenate(([0], sweep_starts, [len(voltage)]))
 
-        counts = {
-            "Total Sweeps": forward_count + reverse_count,
-            "Forward Sweeps": forward_count,
-            "Reverse Sweeps": reverse_count
-        }
-        data = {}
+        sweeps = []
         forward_counter = 1
         reverse_counter = 2
-
-        for segment in sweeps_data:
-            if len(segment) > 1 and segment['V'].iloc[1] > segment['V'].iloc[0]:
-                key = f"{forward_counter}_Forward"
-                data[key] = segment
+        for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            if end - start > 1 and voltage[start + 1] > voltage[start]:
+                sweeps.append((f"{forward_counter}_Forward", start, end))
                 forward_counter += 2
             else:  # Current sweep is reverse
-                key = f"{reverse_counter}_Reverse"
-                data[key] = segment
+                sweeps.append((f"{reverse_counter}_Reverse", start, end))
                 reverse_counter += 2
-        return {"Counts": counts, "Data": data, 'Unit': unit}
+        return sweeps
+
+
+class LazySweepData(MutableMapping):
+    """
+    The sweeps of a file found by the metadata-only scan.
+
+    The sweep names are known from the scan, so checking which sweeps a file has does not read anything. The file is
+    parsed again (or taken from the parse cache) only when the data of a sweep are accessed for the first time.
+    """
+
+    def __init__(self, sweeps: List[str], path: str, cache=None):
+        """
+        :param sweeps: The sweep names in the order of the measurement.
+        :param path: Path to the file.
+        :param cache: (Optional) ParseCache instance to look the data up in before parsing the file.
+        """
+        self.sweeps = list(sweeps)
+        self.path = path
+        self.cache = cache
+        self.data = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.data is not None
+
+    def load(self) -> dict:
+        """
+        Read the data of all the sweeps of the file.
+
+        :return: Dictionary mapping the sweep names to the DataFrames with 'V' and 'I' columns.
+        """
+        if self.data is None:
+            checker = PotentiostatFileChecker(parent=None, cache=self.cache)
+            result = checker.check_file(self.path)
+            self.data = result[3]['Data'] if result[0] else {}
+            self.sweeps = list(self.data)
+        return self.data
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __setitem__(self, key, value):
+        self.load()[key] = value
+        if key not in self.sweeps:
+            self.sweeps.append(key)
+
+    def __delitem__(self, key):
+        del self.load()[key]
+        self.sweeps.remove(key)
+
+    def __contains__(self, key):
+        return key in self.sweeps
+
+    def __iter__(self):
+        return iter(self.sweeps)
+
+    def __len__(self):
+        return len(self.sweeps)
+
+    def __getstate__(self):
+        # The cache belongs to the main process and is not sent to (or from) the worker processes
+        return {**self.__dict__, 'cache': None}
+
+
+def classify_in_worker(task: tuple) -> tuple:
+    """
+    Classify and parse a single file in a worker process.
+
+    :param task: Tuple (path to the file, file extension, potentiostat choice, metadata-only flag).
+    :return: Tuple (packed check_file result, messages to show, whether the application should be closed).
+    """
+    file, file_extension, potentiostat_choice, metadata_only = task
+    checker = PotentiostatFileChecker(parent=None, potentiostat_choice=potentiostat_choice,
+                                      metadata_only=metadata_only)
+    result = checker.classify(file, file_extension)
+    return checker.pack_result(result), checker.messages, checker.exit_requested
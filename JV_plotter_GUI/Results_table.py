@@ -0,0 +1,89 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+
+
+class ResultsTable:
+    """
+    Columnar store of the calculated parameters of all the devices.
+
+    One row per (folder, device, sweep), where the sweep is 'Forward', 'Reverse' or 'Average', and one column per
+    parameter (including the error columns '<parameter> <stat>' of the merged substrates). The key columns are
+    'Folder', 'Device', 'Substrate' (the substrate the pixel belongs to, or None) and 'Sweep'. The rows follow the order
+    of the folders and devices in the data dictionary, so walking the table gives the same order as walking the dict.
+
+    The table is built once from the device dictionaries after CalculateIVParameters, and the filters work on it with
+    vectorized group-by operations, dropping the removed devices from it as well. The device dictionaries keep their
+    'Parameters', which are what the merged substrates are made of and what is written out.
+    """
+    key_columns = ['Folder', 'Device', 'Substrate', 'Sweep']
+    sweeps = ['Forward', 'Reverse', 'Average']
+
+    def __init__(self, frame: pd.DataFrame, present: Optional[pd.DataFrame] = None):
+        """
+        :param frame: The table, with the key columns followed by the parameter columns.
+        :param present: (Optional) Boolean table of the parameter columns, False where a device has no such parameter
+                        (as opposed to a NaN value). By default, all the values are present.
+        """
+        self.frame = frame
+        parameter_columns = [column for column in frame.columns if column not in self.key_columns]
+        self.present = present if present is not None else pd.DataFrame(True, index=frame.index,
+                                                                         columns=parameter_columns)
+
+    @classmethod
+    def from_devices(cls, data: Dict[str, Dict[str, Any]],
+                     substrates: Optional[Dict[str, List[str]]] = None) -> 'ResultsTable':
+        """
+        Build the table from the device dictionaries.
+
+        :param data: {folder: {device: device_data}}, the devices without 'Parameters' are left out.
+        :param substrates: (Optional) {substrate: [pixel names]} to fill the 'Substrate' column. A pixel listed in
+                           several substrates gets the first one.
+        :return: The table.
+        """
+        substrate_of = {}
+        for substrate_name, pixel_names in (substrates or {}).items():
+            for pixel_name in pixel_names:
+                substrate_of.setdefault(pixel_name, substrate_name)
+
+        records, presence, parameter_columns = [], [], {}
+        for folder_name, devices in data.items():
+            for device_name, device_data in devices.items():
+                parameters = device_data.get('Parameters')
+                if not parameters:
+                    continue
+                for sweep, values in parameters.items():
+                    parameter_columns.update(dict.fromkeys(values))
+                    records.append({'Folder': folder_name, 'Device': device_name,
+                                    'Substrate': substrate_of.get(device_name), 'Sweep': sweep, **values})
+                    presence.append(dict.fromkeys(values, True))
+        parameter_columns = list(parameter_columns)
+        frame = pd.DataFrame.from_records(records, columns=cls.key_columns + parameter_columns)
+        present = pd.DataFrame.from_records(presence, columns=parameter_columns).notna()
+        return cls(frame, present)
+
+    @property
+    def parameter_columns(self) -> List[str]:
+        return [column for column in self.frame.columns if column not in self.key_columns]
+
+    def sweep(self, sweep: str) -> pd.DataFrame:
+        """
+        The rows of one sweep.
+
+        :param sweep: 'Forward', 'Reverse' or 'Average'.
+        :return: Part of the table, keeping the original index.
+        """
+        return self.frame[self.frame['Sweep'] == sweep]
+
+    def drop_devices(self, devices: Iterable[Tuple[str, str]]) -> None:
+        """
+        Remove all the rows of the devices.
+
+        :param devices: Pairs (folder, device).
+        """
+        devices = pd.MultiIndex.from_tuples(list(devices), names=['Folder', 'Device'])
+        if len(devices) == 0:
+            return
+        keep = ~pd.MultiIndex.from_frame(self.frame[['Folder', 'Device']]).isin(devices)
+        self.frame = self.frame[keep].reset_index(drop=True)
+        self.present = self.present[keep].reset_index(drop=True)
@@ -0,0 +1,250 @@
+from typing import List
+
+import numpy as np
+from scipy.special import lambertw
+
+from JV_plotter_GUI.Batch_IV_engine import BatchIVEngine
+
+BOLTZMANN_OVER_CHARGE = 8.617333262e-5  # V/K
+
+
+def lambertw_of_exp(z: np.ndarray) -> np.ndarray:
+    """
+    Principal branch of the Lambert W function of exp(z), without overflowing exp for the large z.
+
+    :param z: The logarithm of the argument.
+    :return: W(exp(z)).
+    """
+    z = np.asarray(z, dtype=float)
+    large = z > 500
+    w = np.where(large, 0.0, lambertw(np.exp(np.minimum(z, 500))).real)
+    if np.any(large):
+        # Newton iterations of w + ln(w) = z, converging in a few steps from the asymptotic guess
+        big = z[large]
+        w_big = big - np.log(big)
+        for _ in range(4):
+            w_big -= (w_big + np.log(w_big) - big) / (1 + 1 / w_big)
+        w[large] = w_big
+    return w
+
+
+class SingleDiodeFitter:
+    """
+    Fit the single diode model to many sweeps at once.
+
+    The model is I = Iph - I0 * (exp((V + I Rs) / (n Vt)) - 1) - (V + I Rs) / Rsh, with the photocurrent positive. It is
+    evaluated explicitly through the Lambert W function, so the current of all the points of all the sweeps is a single
+    vectorized expression. The five parameters of every sweep (Iph, ln I0, ln n, ln Rs, ln Rsh; the logarithms keep
+    them positive) are found with the Levenberg-Marquardt method run on all the sweeps together: the Jacobian comes
+    from the implicit differentiation of the model (no extra evaluations of W), the 5x5 normal equations of every sweep
+    are summed with np.add.reduceat, and the damping is adapted per sweep. A sweep is converged once the relative
+    decrease of its residual falls under the tolerance (and the residual itself is small), and it is left out of the
+    next iterations. The sweeps are kept in the ragged layout of BatchIVEngine.
+
+    Speed (500 sweeps of 40-200 points): ~0.5 seconds, ~13 iterations per sweep.
+    """
+    parameter_names = ['Photocurrent, Iph (A)', 'Saturation current, I0 (A)', 'Ideality factor, n',
+                       'Series resistance (diode fit), Rs (ohm)', 'Shunt resistance (diode fit), Rsh (ohm)']
+    # Limits of the fitted (Iph, ln I0, ln n, ln Rs, ln Rsh), keeping the model finite
+    lower_bounds = np.array([-np.inf, -100.0, np.log(0.3), np.log(1e-6), np.log(1e-2)])
+    upper_bounds = np.array([np.inf, 0.0, np.log(20.0), np.log(1e9), np.log(1e12)])
+
+    def __init__(self, voltages: List[np.ndarray], currents: List[np.ndarray], temperature: float = 298.15,
+                 max_iterations: int = 100, tolerance: float = 1e-10, max_residual: float = 0.05):
+        """
+        :param voltages: Voltage of every sweep.
+        :param currents: Current of every sweep, in A.
+        :param temperature: (Optional) Temperature of the devices, in K.
+        :param max_iterations: (Optional) The largest number of the Levenberg-Marquardt iterations.
+        :param tolerance: (Optional) Relative decrease of the residual under which a sweep is converged.
+        :param max_residual: (Optional) The largest RMS relative residual (see fit) of a converged sweep. A fit stuck
+                             further from the data (a dead cell, for example) is not converged.
+        """
+        self.layout = BatchIVEngine(voltages, currents)
+        self.thermal_voltage = BOLTZMANN_OVER_CHARGE * temperature
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.max_residual = max_residual
+        valid = np.isfinite(self.layout.voltage) & np.isfinite(self.layout.current)
+        self.weights = valid.astype(float)
+        self.voltage = np.where(valid, self.layout.voltage, 0.0)
+        self.current = np.where(valid, self.layout.current, 0.0)
+        self.iterations = np.zeros(len(self.layout.lengths), dtype=np.int64)
+        self.converged = np.zeros(len(self.layout.lengths), dtype=bool)
+        self.residuals = np.full(len(self.layout.lengths), np.nan)
+
+    def initial_guess(self, isc: np.ndarray, voc: np.ndarray, rs: np.ndarray, rsh: np.ndarray) -> np.ndarray:
+        """
+        Build the starting parameters from the results of BatchIVEngine.
+
+        :param isc: Isc of every sweep, in A.
+        :param voc: Voc of every sweep.
+        :param rs: Rs of every sweep, from the two-point fit.
+        :param rsh: Rsh of every sweep, from the fit around V = 0.
+        :return: Array (sweeps, 5) of the fitted (Iph, ln I0, ln n, ln Rs, ln Rsh).
+        """
+        n = np.full(len(isc), 1.5)
+        a = n * self.thermal_voltage
+        rsh = np.clip(np.nan_to_num(rsh, nan=1e4), 1.0, 1e9)
+        iph = np.abs(np.nan_to_num(isc)) + 1e-12
+        # The slope around Voc is Rs plus the dynamic resistance of the diode, about a / Iph there
+        rs = np.clip(np.nan_to_num(rs, nan=1.0), 1e-4, 1e4)
+        rs = np.clip(np.maximum(rs - a / iph, 0.05 * rs), 1e-4, 1e4)
+        iph = iph * (1 + rs / rsh)
+        max_voltage = np.fmax.reduceat(np.where(self.weights > 0, self.voltage, -np.inf), self.layout.starts)
+        voc = np.where(np.isfinite(voc) & (voc > 0), voc, np.maximum(max_voltage, 0.1))
+        log_i0 = np.log(np.maximum(iph - voc / rsh, 1e-3 * iph)) - voc / a
+        return np.clip(np.stack([iph, log_i0, np.log(n), np.log(rs), np.log(rsh)], axis=-1), self.lower_bounds,
+                       self.upper_bounds)
+
+    def model(self, parameters: np.ndarray) -> np.ndarray:
+        """
+        Current of the single diode model at every point.
+
+        :param parameters: Array (sweeps, 5) of (Iph, ln I0, ln n, ln Rs, ln Rsh).
+        :return: The current at the voltage of every point.
+        """
+        return self.current_of(np.repeat(parameters, self.layout.lengths, axis=0), self.voltage)
+
+    def current_of(self, point_parameters: np.ndarray, voltage: np.ndarray) -> np.ndarray:
+        """
+        Current of the single diode model, explicitly through the Lambert W function.
+
+        :param point_parameters: Array (points, 5) of (Iph, ln I0, ln n, ln Rs, ln Rsh) of the sweep of every point.
+        :param voltage: Voltage of the points.
+        :return: The current of the points.
+        """
+        iph, log_i0, log_n, log_rs, log_rsh = point_parameters.T
+        i0, rs, rsh = np.exp(log_i0), np.exp(log_rs), np.exp(log_rsh)
+        a = np.exp(log_n) * self.thermal_voltage
+        total = rs + rsh
+        log_x = log_rs + log_rsh + log_i0 - np.log(a) - np.log(total) + rsh * (rs * (iph + i0) + voltage) / (a * total)
+        return (rsh * (iph + i0) - voltage) / total - a / rs * lambertw_of_exp(log_x)
+
+    def derivatives_of(self, point_parameters: np.ndarray, voltage: np.ndarray, current: np.ndarray) -> np.ndarray:
+        """
+        Derivatives of the model current by the parameters, from the implicit equation of the model
+        F = Iph - I0 (exp((V + I Rs) / a) - 1) - (V + I Rs) / Rsh - I = 0, dI/dp = -(dF/dp) / (dF/dI).
+
+        :param point_parameters: Array (points, 5) of (Iph, ln I0, ln n, ln Rs, ln Rsh) of the sweep of every point.
+        :param voltage: Voltage of the points.
+        :param current: The model current of the points, see current_of.
+        :return: Array (points, 5) of the derivatives.
+        """
+        iph, log_i0, log_n, log_rs, log_rsh = point_parameters.T
+        i0, rs, rsh = np.exp(log_i0), np.exp(log_rs), np.exp(log_rsh)
+        a = np.exp(log_n) * self.thermal_voltage
+        junction = voltage + current * rs
+        # I0 exp((V + I Rs) / a), taken from the model equation itself, so it does not overflow
+        diode = iph + i0 - current - junction / rsh
+        d_current = -diode * rs / a - rs / rsh - 1
+        d_parameters = np.column_stack([np.ones_like(iph), -(diode - i0), diode * junction / a,
+                                        -rs * current * (diode / a + 1 / rsh), junction / rsh])
+        return -d_parameters / d_current[:, None]
+
+    def fit(self, initial: np.ndarray) -> np.ndarray:
+        """
+        Fit all the sweeps. Every iteration works on the points of the sweeps which have not converged yet only.
+
+        :param initial: Array (sweeps, 5) of the starting (Iph, ln I0, ln n, ln Rs, ln Rsh), see initial_guess.
+        :return: Array (sweeps, 5) of the fitted Iph, I0, n, Rs, Rsh. The sweeps with fewer than five valid points are
+                 NaN, the ones which did not converge are returned as they are. The iterations, the convergence and the
+                 RMS relative residual of every sweep are kept in the attributes.
+        """
+        n_sweeps = len(self.layout.lengths)
+        parameters = np.clip(np.array(initial, dtype=float).reshape(n_sweeps, 5), self.lower_bounds, self.upper_bounds)
+        points = np.add.reduceat(self.weights, self.layout.starts) if n_sweeps else np.empty(0)
+        fittable = points >= 5
+        cost = np.full(n_sweeps, np.nan)
+        active = np.flatnonzero(fittable)
+        damping = np.full(len(active), 1e-3)
+        # The residuals are relative to the photocurrent of the starting parameters, or to the measured current where it
+        # is larger (far in the forward bias), so these few points do not outweigh the rest of the sweep
+        scale = np.maximum(np.abs(parameters[:, 0]), 1e-12)
+
+        def select(sweeps):
+            """The points of the sweeps, as (point indexes, local starts, sweep of every point)."""
+            lengths = self.layout.lengths[sweeps]
+            local_starts = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+            owner = np.repeat(np.arange(len(sweeps)), lengths)
+            return self.layout.starts[sweeps][owner] + np.arange(len(owner)) - local_starts[owner], local_starts, owner
+
+        def point_scale_of(sweeps, indexes, owner):
+            return np.maximum(scale[sweeps][owner], np.abs(self.current[indexes]))
+
+        def evaluate(values, indexes, owner):
+            """Model current and the weighted residuals of the selected points."""
+            with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+                model_current = self.current_of(values[owner], self.voltage[indexes])
+                residuals = (model_current - self.current[indexes]) * weights / point_scale
+            return model_current, np.nan_to_num(residuals, nan=1e6, posinf=1e6, neginf=-1e6)
+
+        indexes, local_starts, owner = select(active)
+        weights, point_scale = self.weights[indexes], point_scale_of(active, indexes, owner)
+        model_current, residuals = evaluate(parameters[active], indexes, owner)
+        if len(active):
+            cost[active] = np.add.reduceat(residuals ** 2, local_starts)
+
+        for _ in range(self.max_iterations):
+            if not len(active):
+                break
+            self.iterations[active] += 1
+            values = parameters[active]
+            with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+                jacobian = self.derivatives_of(values[owner], self.voltage[indexes], model_current)
+                jacobian *= (weights / point_scale)[:, None]
+            jacobian = np.nan_to_num(jacobian, nan=0.0, posinf=0.0, neginf=0.0)
+            normal = np.add.reduceat(jacobian[:, :, None] * jacobian[:, None, :], local_starts, axis=0)
+            gradient = np.add.reduceat(jacobian * residuals[:, None], local_starts, axis=0)
+
+            diagonal = np.einsum('kii->ki', normal)
+            damped = normal + (damping[:, None] * diagonal + 1e-12)[:, :, None] * np.eye(5)
+            try:
+                step = np.linalg.solve(damped, -gradient[:, :, None])[:, :, 0]
+            except np.linalg.LinAlgError:
+                step = -gradient / np.maximum(np.einsum('kii->ki', damped), 1e-12)
+            trial = np.clip(values + np.where(np.isfinite(step), step, 0.0), self.lower_bounds, self.upper_bounds)
+            trial_current, trial_residuals = evaluate(trial, indexes, owner)
+            trial_cost = np.add.reduceat(trial_residuals ** 2, local_starts)
+
+            accepted = trial_cost < cost[active]
+            decrease = np.where(accepted, (cost[active] - trial_cost) / np.maximum(cost[active], 1e-300), 0.0)
+            parameters[active] = np.where(accepted[:, None], trial, values)
+            cost[active] = np.where(accepted, trial_cost, cost[active])
+            damping = np.where(accepted, damping / 3, damping * 4)
+            accepted_points = accepted[owner]
+            residuals = np.where(accepted_points, trial_residuals, residuals)
+            model_current = np.where(accepted_points, trial_current, model_current)
+
+            # Converged on a small decrease or step, or when no step decreases the residual anymore
+            small_step = np.max(np.abs(trial - values), axis=1) < 1e-9
+            done = (accepted & ((decrease < self.tolerance) | small_step)) | (damping > 1e12)
+            if np.any(done):
+                self.converged[active[done]] = True
+                keep = ~done
+                active, damping = active[keep], damping[keep]
+                kept_points = keep[owner]
+                residuals, model_current = residuals[kept_points], model_current[kept_points]
+                indexes, local_starts, owner = select(active)
+                weights, point_scale = self.weights[indexes], point_scale_of(active, indexes, owner)
+
+        self.residuals = np.where(fittable, np.sqrt(cost / np.maximum(points, 1)), np.nan)
+        self.converged &= self.residuals < self.max_residual
+        self.fitted = np.where(fittable[:, None], parameters, np.nan)
+        result = np.column_stack([parameters[:, 0], np.exp(parameters[:, 1:])])
+        return np.where(fittable[:, None], result, np.nan)
+
+    @staticmethod
+    def summary(converged: np.ndarray, iterations: np.ndarray, residuals: np.ndarray) -> str:
+        """
+        Convergence statistics of the fits, to be shown to the user.
+
+        :param converged: The converged flags of the sweeps.
+        :param iterations: The iterations of the sweeps.
+        :param residuals: The RMS relative residuals of the sweeps, see fit.
+        """
+        if len(converged) == 0:
+            return 'Single diode fit: no sweeps'
+        residual = np.nanmedian(residuals) if np.any(np.isfinite(residuals)) else np.nan
+        return (f'Single diode fit: {int(np.sum(converged))} of {len(converged)} sweeps converged, '
+                f'median iterations {int(np.median(iterations))}, median RMS relative residual {residual:.2e}')
@@ -0,0 +1,168 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from JV_plotter_GUI.Device_records import ParameterSet
+from JV_plotter_GUI.Results_table import ResultsTable
+
+
+class SubstrateStatistics:
+    """
+    The mean and all the error metrics of the parameters of the pixels of every substrate.
+
+    The parameters of the pixels are taken from the results table (see ResultsTable) and laid out as one tidy table
+    with a row per (folder, substrate, sweep, parameter, pixel), in which the rows of a group (folder, substrate, sweep,
+    parameter) are contiguous. The mean and the metrics of all the groups are then computed at once (see group_sums),
+    with the formulas of PixelMerger.average_parameters:
+    - Standard Deviation ('std_dev'), the sample one
+    - Mean Absolute Error ('mae')
+    - Mean Squared Error ('mse')
+    - Root Mean Squared Error ('rmse')
+    - Mean Absolute Percentage Error ('mape'), the NaN converted to 0
+    - Median Absolute Deviation ('mad')
+    So switching the error metric only picks another column of the statistics (see parameters).
+
+    Speed (10 folders, 20 substrates of 1-6 pixels, 14 parameters):
+    - PixelMerger.average_parameters, one metric: ~0.19 seconds
+    - SubstrateStatistics from the results table, all the metrics: ~0.05 seconds
+    """
+    stats = ['std_dev', 'mae', 'mse', 'rmse', 'mape', 'mad']
+    key_columns = ['Folder', 'Substrate', 'Sweep', 'Parameter']
+    sweeps = ['Forward', 'Reverse', 'Average']
+
+    def __init__(self, results: ResultsTable, substrates: Dict[str, List[str]]):
+        """
+        :param results: The results table of the pixels.
+        :param substrates: {substrate: [pixel names]}.
+        """
+        self.table, self.counts = self.tidy(results, substrates)
+        self.statistics = self.aggregate(self.table['Value'].to_numpy(dtype=float), self.counts)
+        starts = np.cumsum(self.counts) - self.counts
+        for column in reversed(self.key_columns):
+            self.statistics.insert(0, column, self.table[column].to_numpy()[starts])
+
+    @classmethod
+    def tidy(cls, results: ResultsTable, substrates: Dict[str, List[str]]) -> Tuple[pd.DataFrame, np.ndarray]:
+        """
+        Lay out the parameters of the pixels of every substrate.
+
+        The rows of the results table are joined with the substrate lists (a pixel listed in several substrates counts
+        for every one of them) and sorted by the folder, substrate, sweep and parameter, in the order of the data, the
+        substrates, cls.sweeps and the parameter columns. Within a group, the pixels follow the order of the substrate
+        list, so the values are added in the same order as in PixelMerger.merge_pixels. The parameters a pixel does not
+        have are left out.
+
+        :param results: The results table of the pixels.
+        :param substrates: {substrate: [pixel names]}.
+        :return: The tidy table (the key columns and 'Value') and the number of rows of every group.
+        """
+        frame, columns = results.frame, results.parameter_columns
+        membership = pd.DataFrame([(pixel_name, substrate_rank, position)
+                                   for substrate_rank, pixel_group in enumerate(substrates.values())
+                                   for position, pixel_name in enumerate(pixel_group)],
+                                  columns=['Device', 'substrate rank', 'position'])
+        sweep_ranks = frame['Sweep'].map({sweep: rank for rank, sweep in enumerate(cls.sweeps)})
+        folder_ranks, folder_names = pd.factorize(frame['Folder'])
+        rows = pd.DataFrame({'Device': frame['Device'], 'row': np.arange(len(frame))})[sweep_ranks.notna().to_numpy()]
+        rows = rows.merge(membership, on='Device')
+        row_index = rows['row'].to_numpy()
+
+        # One entry per (joined row, present parameter)
+        joined, parameter_ranks = np.nonzero(results.present[columns].to_numpy(dtype=bool)[row_index])
+        values = frame[columns].to_numpy(dtype=float)[row_index[joined], parameter_ranks]
+        folder_ranks = folder_ranks[row_index[joined]]
+        substrate_ranks = rows['substrate rank'].to_numpy()[joined]
+        sweep_ranks = sweep_ranks.to_numpy(dtype=np.int64)[row_index[joined]]
+        order = np.lexsort((rows['position'].to_numpy()[joined], parameter_ranks, sweep_ranks, substrate_ranks,
+                            folder_ranks))
+        keys = [folder_ranks[order], substrate_ranks[order], sweep_ranks[order], parameter_ranks[order]]
+
+        new_group = np.ones(len(order), dtype=bool)
+        new_group[1:] = np.any([key[1:] != key[:-1] for key in keys], axis=0) if len(order) else []
+        counts = np.diff(np.append(np.flatnonzero(new_group), len(order))).astype(np.int64)
+        table = pd.DataFrame({
+            'Folder': np.asarray(folder_names, dtype=object)[keys[0]],
+            'Substrate': np.array(list(substrates), dtype=object)[keys[1]],
+            'Sweep': np.array(cls.sweeps, dtype=object)[keys[2]],
+            'Parameter': np.array(columns, dtype=object)[keys[3]],
+            'Value': values[order],
+        })
+        return table, counts
+
+    @staticmethod
+    def group_sums(values: np.ndarray, starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        """
+        The sum of every group of contiguous values.
+
+        The groups are laid out as the rows of a zero-padded array, summed along the rows. Unlike np.add.reduceat,
+        this adds the values in the same order as np.sum of every group on its own (for the groups of up to 7 values
+        exactly, the trailing zeros do not change the sum), so the results are the same as those of
+        PixelMerger.average_parameters.
+        """
+        rows = np.repeat(np.arange(len(counts)), counts)
+        columns = np.arange(len(values)) - np.repeat(starts, counts)
+        padded = np.zeros((len(counts), counts.max()))
+        padded[rows, columns] = values
+        return padded.sum(axis=1)
+
+    @staticmethod
+    def group_medians(values: np.ndarray, starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        """
+        The median of every group of contiguous values, NaN for the groups with a NaN (like np.median).
+        """
+        groups = np.repeat(np.arange(len(counts)), counts)
+        ordered = values[np.lexsort((values, groups))]
+        lower, upper = ordered[starts + (counts - 1) // 2], ordered[starts + counts // 2]
+        medians = (lower + upper) / 2
+        has_nan = np.add.reduceat(np.isnan(values), starts) > 0
+        return np.where(has_nan, np.nan, medians)
+
+    @classmethod
+    def aggregate(cls, values: np.ndarray, counts: np.ndarray) -> pd.DataFrame:
+        """
+        The mean and all the metrics of every group of contiguous values.
+
+        :param values: The values, the groups one after another.
+        :param counts: The number of values of every group.
+        :return: Table with the 'mean' and a column per metric, a row per group.
+        """
+        if len(counts) == 0:
+            return pd.DataFrame(columns=['mean'] + cls.stats, dtype=float)
+        starts = np.cumsum(counts) - counts
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = cls.group_sums(values, starts, counts) / counts
+            deviations = values - np.repeat(mean, counts)
+            squared = cls.group_sums(deviations * deviations, starts, counts)
+            absolute = cls.group_sums(np.abs(deviations), starts, counts)
+            relative = cls.group_sums(np.abs(deviations / values), starts, counts)
+            medians = cls.group_medians(values, starts, counts)
+            absolute_deviations = np.abs(values - np.repeat(medians, counts))
+            statistics = {
+                'mean': mean,
+                'std_dev': np.sqrt(squared / (counts - 1)),
+                'mae': absolute / counts,
+                'mse': squared / counts,
+                'rmse': np.sqrt(squared / counts),
+                'mape': np.nan_to_num(relative / counts * 100),
+                'mad': cls.group_medians(absolute_deviations, starts, counts),
+            }
+        return pd.DataFrame(statistics)
+
+    def parameters(self, stat: str) -> Dict[Tuple[str, str, str], ParameterSet]:
+        """
+        The averaged parameters of the substrates, with the errors of one metric.
+
+        :param stat: One of the stats.
+        :return: {(folder, substrate, sweep): {parameter: mean, '<parameter> <stat>': error, ...}}.
+        """
+        if stat not in self.stats:
+            raise ValueError(f"Unknown stat: {stat}")
+        result = {}
+        keys = self.statistics[['Folder', 'Substrate', 'Sweep', 'Parameter']].itertuples(index=False, name=None)
+        for (folder_name, substrate_name, sweep, parameter), mean, error in zip(
+                keys, self.statistics['mean'].tolist(), self.statistics[stat].tolist()):
+            parameters = result.setdefault((folder_name, substrate_name, sweep), ParameterSet())
+            parameters[parameter] = mean
+            parameters[f'{parameter} {stat}'] = error
+        return result
@@ -4,11 +4,16 @@ import random
 import subprocess
 import sys
 from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, List, Optional
 
 import pandas as pd
 from natsort import natsorted
 from pandas import DataFrame
 
+from JV_plotter_GUI.settings import settings
+
 
 def open_file(path_to_file):
     """
@@ -32,7 +37,7 @@ def print_nested_dict(d, indent=0) -> None:
     """
     for key, value in d.items():
         print('  ' * indent + str(key))
-        if isinstance(value, dict):
+        if isinstance(value, Mapping):
             print_nested_dict(value, indent + 1)
         else:
             print('  ' * (indent + 1) + str(value))
@@ -118,7 +123,7 @@ def convert_df_to_dict(obj):
     """
     if isinstance(obj, pd.DataFrame):
         return obj.to_dict()
-    elif isinstance(obj, dict):
+    elif isinstance(obj, MutableMapping):
         for key in obj.keys():
             obj[key] = convert_df_to_dict(obj[key])
     return obj
@@ -126,16 +131,16 @@ def convert_df_to_dict(obj):
 
 def remove_data_key(d):
     """
-    Recursively remove the 'data' key from a dictionary.
+    Recursively remove the 'data' key from a dictionary (or any mapping, e.g. the Device records).
 
     :param d: dictionary to process
-    :return: new dictionary without 'data' keys
+    :return: new dictionary without 'data' keys, with all the nested mappings as dictionaries
     """
     new_dict = {}
     for key, value in d.items():
         if key == 'data':
             continue
-        if isinstance(value, dict):
+        if isinstance(value, Mapping):
             new_dict[key] = remove_data_key(value)
         else:
             new_dict[key] = value
@@ -213,3 +218,32 @@ def validate_numeric_entry(event):
     else:
         # If the input is valid, store the current value as the last valid value.
         entry_widget.last_valid_value = text
+
+
+def parallel_map(function: Callable, items: Iterable, workers: Optional[int] = None,
+                 min_items_per_worker: Optional[int] = None) -> List:
+    """
+    Apply a function to every item in a process pool, keeping the order of the items.
+    Small batches (fewer than min_items_per_worker items per worker) and a single worker are processed in the current
+    process, since starting the pool would take longer than the work itself.
+
+    :param function: A picklable (module-level) function of one argument.
+    :param items: The arguments for the function, any iterable (it is turned into a list first).
+    :param workers: (Optional) Number of worker processes. Defaults to settings['Parallel processing']['workers'],
+                    1 (no pool); 0 means one worker per CPU core.
+    :param min_items_per_worker: (Optional) Defaults to settings['Parallel processing']['min_items_per_worker'].
+                                 Use 1 for the items which are large pieces of work on their own.
+    :return: List of the results in the order of the items.
+    """
+    items = list(items)
+    if workers is None:
+        workers = settings['Parallel processing']['workers']
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    if min_items_per_worker is None:
+        min_items_per_worker = settings['Parallel processing']['min_items_per_worker']
+    workers = min(workers, len(items) // max(min_items_per_worker, 1))
+    if workers <= 1:
+        return [function(item) for item in items]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, items, chunksize=max(len(items) // (workers * 4), 1)))
@@ -8,6 +8,41 @@ settings = {
     'Main frame': {
         'table_size': 15
     },
+    'Parse cache': {
+        'enabled': True,
+        'directory': None,  # None -> ~/.jv_processor/parse_cache
+        'max_size_mb': 512,
+        'max_entries': 100000,  # Files, including the non-matching and metadata-only ones without an archive
+    },
+    'Parameter memo': {
+        'enabled': True,
+        'directory': None,  # None -> ~/.jv_processor
+        'max_entries': 200000,  # Sweeps, ~100 bytes each
+    },
+    'Single diode fit': {
+        'enabled': False,  # True -> fit every sweep (not memoized), the results are kept in the JSON dump only
+        'temperature (K)': 298.15,
+        'max_iterations': 100,
+        'tolerance': 1e-10,  # Relative decrease of the residual at which a fit is converged
+    },
+    'File scan': {
+        'metadata_only': False,  # True -> keep only the units and sweep counts, read the data when they are needed
+    },
+    'Sweep store': {
+        'dtype': 'float64',  # 'float32' -> half the memory for the V and I of the sweeps, ~7 significant digits
+    },
+    'Sweep averaging': {
+        'spread': False,  # True -> the standard deviation of the averaged sweeps at every point, 'I spread' in the JSON
+    },
+    'Parallel processing': {
+        'workers': 1,  # 1 -> no process pool, 0 -> one worker process per CPU core
+        'min_items_per_worker': 8,
+    },
+    'IV calculation': {
+        'sharded': False,  # True -> calculate every top-level folder (date in the aging mode) in its own worker process
+        'workers': None,  # None -> settings['Parallel processing']['workers']
+        'interpolate': False,  # True -> MPP and Voc between the measured points, from local quadratics
+    },
     'DevicePlotter': {
         'chart_x_scale': 1,  # 480 pixels
         'chart_y_scale': 1,  # 288 pixels
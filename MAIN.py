@@ -1,3 +1,4 @@
+import multiprocessing
 from tkinter import ttk
 
 import customtkinter as ctk
@@ -21,6 +22,8 @@ class JVProcessorMAIN(ctk.CTk):
 
 
 if __name__ == "__main__":
+    # The process pools (settings['Parallel processing']) start the frozen executable again in their workers
+    multiprocessing.freeze_support()
     ctk.set_appearance_mode("dark")
     jv_processor_app = JVProcessorMAIN()
     jv_processor_app.mainloop()